@@ -1,19 +1,23 @@
 import math
 import numpy as np
-import random
-from numpy import random as Random
 import torch 
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
-from torch.distributions import Categorical
-from collections import namedtuple, deque
+from collections import namedtuple
 import matplotlib
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from IPython.display import HTML
 from tqdm import tqdm
 import pickle
+import copy
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from tasep_kernels import LatticeState, KineticState, initial_lattice, NO_MOVE, MOVE_FORWARD, MOVE_UP, MOVE_DOWN
+from rewards import Reward
 
 is_ipython = 'inline' in matplotlib.get_backend()
 if is_ipython:
@@ -25,18 +29,138 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward'))
 # class that defines the Q table
 class ReplayMemory(object):
-    def __init__(self, capacity):
-        self.memory = deque([], maxlen=capacity) # deque is a more efficient form of a list
-
-    def push(self, *args):
+ # ring buffer of transitions stored in preallocated contiguous tensors; once it is full, push overwrites the oldest transition.
+ # With compact = True the 0/1 fast and slow channels are bit-packed in uint8 (8 sites per byte), the distance to the center
+ # is kept as float16 and the actions as int16 (int32 from 32768 cells, as whole-lattice actions can be), so a transition takes
+ # ~2*(L*L/4 + 2) bytes instead of 8*(2*L*L + 1);
+ # the states are decoded back to float32 when a batch is sampled.
+ # With store_moves = True the next states are not stored: push_move saves the patch indices (source, destination) of the move
+ # instead (-1 when there is none), and the next states are rebuilt from the states with a scatter when a batch is sampled.
+ # This needs next_state to be the same patch as state with at most one particle moved (L <= Lx and L <= Ly).
+ # The batches are drawn from the numpy generator seeded with seed (see seed_sequence)
+    def __init__(self, capacity, n_observations, compact = False, store_moves = False, seed = None):
+        self.capacity = capacity
+        self.rng = np.random.default_rng(seed)
+        self.n_observations = n_observations
+        self.n_cells = (n_observations - 1) // 2 # L*L sites per channel
+        self.compact = compact
+        self.store_moves = store_moves
+        # actions and move indices are cell indices (< n_cells); int16 would wrap silently above its range
+        index_dtype = torch.int16 if self.n_cells <= torch.iinfo(torch.int16).max + 1 else torch.int32
+        if store_moves:
+            self.moves = torch.full((capacity, 2), -1, dtype=index_dtype, device=device)
+        if compact:
+            self.n_bits = n_observations - 1 # the last observation is the distance to the center
+            self.n_bytes = (self.n_bits + 7) // 8
+            self.bit_weights = 2**torch.arange(7, -1, -1, device=device) # most significant bit first
+            self.bit_shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=device)
+            self.states = torch.zeros((capacity, self.n_bytes), dtype=torch.uint8, device=device)
+            self.distances = torch.zeros(capacity, dtype=torch.float16, device=device)
+            if not store_moves:
+                self.next_states = torch.zeros((capacity, self.n_bytes), dtype=torch.uint8, device=device)
+                self.next_distances = torch.zeros(capacity, dtype=torch.float16, device=device)
+            self.actions = torch.zeros((capacity, 1), dtype=index_dtype, device=device)
+        else:
+            self.states = torch.zeros((capacity, n_observations), dtype=torch.float32, device=device)
+            if not store_moves:
+                self.next_states = torch.zeros((capacity, n_observations), dtype=torch.float32, device=device)
+            self.actions = torch.zeros((capacity, 1), dtype=torch.long, device=device)
+        self.rewards = torch.zeros(capacity, dtype=torch.float32, device=device)
+        self.position = 0 # next row to write
+        self.size = 0
+        self.lock = threading.Lock() # push and sample can run in different threads (see Learner)
+
+    def encode(self, state):
+     # packs the channels of a state (n_observations values) into n_bytes uint8
+        bits = torch.zeros(self.n_bytes*8, dtype=torch.long, device=device)
+        bits[:self.n_bits] = state.view(-1)[:self.n_bits]
+        return (bits.view(self.n_bytes, 8)*self.bit_weights).sum(dim=1).to(torch.uint8)
+
+    def decode(self, packed, distances):
+     # unpacks a batch of states (BATCH x n_bytes) and their distances to the center into float32 (BATCH x n_observations)
+        bits = (packed.unsqueeze(-1) >> self.bit_shifts) & 1
+        bits = bits.view(packed.shape[0], self.n_bytes*8)[:, :self.n_bits]
+        return torch.cat((bits.float(), distances.float().unsqueeze(1)), dim=1)
+
+    def push(self, state, action, next_state, reward):
         """Save a transition"""
-        self.memory.append(Transition(*args))
+        with self.lock:
+            if self.compact:
+                self.states[self.position] = self.encode(state)
+                self.next_states[self.position] = self.encode(next_state)
+                self.distances[self.position] = state.view(-1)[-1]
+                self.next_distances[self.position] = next_state.view(-1)[-1]
+            else:
+                self.states[self.position] = state.view(-1)
+                self.next_states[self.position] = next_state.view(-1)
+            self.push_common(action, reward)
+
+    def push_move(self, state, action, move, reward):
+        """Save a transition given by the move (source, destination) of the patch indices, see store_moves"""
+        with self.lock:
+            if self.compact:
+                self.states[self.position] = self.encode(state)
+                self.distances[self.position] = state.view(-1)[-1]
+            else:
+                self.states[self.position] = state.view(-1)
+            self.moves[self.position, 0] = move[0]
+            self.moves[self.position, 1] = move[1]
+            self.push_common(action, reward)
+
+    def push_common(self, action, reward):
+     # fields shared by push and push_move; moves the ring buffer forward (called with the lock held)
+        self.actions[self.position] = action.view(-1)
+        self.rewards[self.position] = reward.view(-1)
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def apply_moves(self, states, moves):
+     # rebuilds the next states (BATCH x n_observations) from the states and the moves (BATCH x 2): the particle at the source
+     # index is removed from its channel and, if the destination is inside the patch, placed there
+        next_states = states.clone()
+        rows = torch.nonzero(moves[:, 0] >= 0).squeeze(1)
+        source = moves[rows, 0]
+        destination = moves[rows, 1]
+        fast = next_states[rows, source]
+        slow = next_states[rows, self.n_cells + source]
+        next_states[rows, source] = 0
+        next_states[rows, self.n_cells + source] = 0
+
+        inside = destination >= 0
+        rows, destination = rows[inside], destination[inside]
+        next_states[rows, destination] = fast[inside]
+        next_states[rows, self.n_cells + destination] = slow[inside]
+
+        return next_states
 
     def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
+     # returns a Transition of batches (states: BATCH x n_observations, actions: BATCH x 1, ...) drawn uniformly with replacement
+        with self.lock: # gathers the rows; the decoding below works on copies
+            indices = torch.as_tensor(self.rng.integers(0, self.size, batch_size), device=device)
+            states = self.states[indices]
+            actions = self.actions[indices]
+            rewards = self.rewards[indices]
+            if self.store_moves:
+                moves = self.moves[indices].long()
+            else:
+                next_states = self.next_states[indices]
+            if self.compact:
+                distances = self.distances[indices]
+                if not self.store_moves:
+                    next_distances = self.next_distances[indices]
+
+        if self.compact:
+            states = self.decode(states, distances)
+            actions = actions.long()
+        if self.store_moves:
+            next_states = self.apply_moves(states, moves)
+        elif self.compact:
+            next_states = self.decode(next_states, next_distances)
+
+        return Transition(states, actions, next_states, rewards)
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
 
 class DQN(nn.Module):
     def __init__(self, n_observations, hidden_size, n_actions):
@@ -48,37 +172,184 @@ class DQN(nn.Module):
         x = F.relu(self.layer1(x))
         return self.layer2(x)
 
+class ConvDQN(nn.Module):
+ # fully convolutional Q-network over the whole periodic lattice: the input are the fast and slow channels of the system
+ # plus a channel with the distance of every row to the center (the last entry of the patch states), the output is the
+ # Q value of selecting each site. layer1 sees the L x L window of the site, aligned as the patches of PatchExtractor
+ # (circular padding, int(L/2) sites before), and layer2 is 1x1, so every site is scored in one pass on a lattice of any size.
+ # forward takes the flat whole-lattice states of whole_lattice_states (BATCH x 2*Lx*Ly+1) of the training system
+    def __init__(self, Lx, Ly, L, hidden_size):
+        super(ConvDQN, self).__init__()
+        self.Lx, self.Ly = Lx, Ly
+        self.padding = (int(L/2), L - 1 - int(L/2))
+        self.layer1 = nn.Conv2d(3, hidden_size, L)
+        self.layer2 = nn.Conv2d(hidden_size, 1, 1)
+
+    def q_map(self, channels):
+     # Q values (BATCH x Lx x Ly) of the fast and slow channels (BATCH x 2 x Lx x Ly)
+        batch, _, Lx, Ly = channels.shape
+        distance = torch.abs(torch.arange(Ly, device=channels.device) - int(Ly / 2))/int(Ly / 2)
+        x = torch.cat((channels, distance.to(channels.dtype).expand(batch, 1, Lx, Ly)), dim=1)
+        before, after = self.padding
+        x = F.pad(x, (before, after, before, after), mode='circular')
+        x = F.relu(self.layer1(x))
+        return self.layer2(x).squeeze(1)
+
+    def forward(self, x):
+        channels = x[:, :-1].reshape(x.shape[0], 2, self.Lx, self.Ly)
+        return self.q_map(channels).reshape(x.shape[0], self.Lx*self.Ly)
+
+class SlidingDQN(nn.Module):
+ # a trained DQN rewritten as convolutions over the whole periodic lattice, see mlp_to_conv: layer1 is an L x L convolution
+ # with circular padding (patch cell i of center Xcenter is Xcenter - int(L/2) + i, as in PatchExtractor), the distance
+ # to the center becomes a per-row bias map and layer2 a 1x1 convolution, so one pass gives the Q values of the patches of every center
+    def __init__(self, L, hidden_size, n_actions):
+        super(SlidingDQN, self).__init__()
+        self.padding = (int(L/2), L - 1 - int(L/2))
+        self.layer1 = nn.Conv2d(2, hidden_size, L)
+        self.distance_weight = nn.Parameter(torch.zeros(hidden_size))
+        self.layer2 = nn.Conv2d(hidden_size, n_actions, 1)
+
+    def forward(self, channels):
+     # Q values (BATCH x L*L x Lx x Ly) of the patches centered at every site, from the fast and slow channels (BATCH x 2 x Lx x Ly)
+        Ly = channels.shape[-1]
+        distance = torch.abs(torch.arange(Ly, device=channels.device) - int(Ly / 2))/int(Ly / 2)
+        before, after = self.padding
+        x = F.pad(channels, (before, after, before, after), mode='circular')
+        x = self.layer1(x) + self.distance_weight[:, None, None]*distance.to(channels.dtype) # bias map (hidden x Ly), the same for every X
+        return self.layer2(F.relu(x))
+
+    def patch_q_values(self, lattice, Xcenters, Ycenters):
+     # Q values (K x L*L) of the K patches with the given centers, as the DQN gives for the states of PatchExtractor.batch
+        with torch.no_grad():
+            Q_maps = self(torch.tensor(lattice_channels(lattice[None]), device=device))[0]
+        return Q_maps[:, Xcenters, Ycenters].T
+
+def mlp_to_conv(dqn, L):
+ # SlidingDQN with the weights of a trained DQN (2L*L+1 -> hidden -> L*L), no retraining: the fast and slow weights of layer1
+ # are the L x L kernels, the weight of the distance multiplies the per-row distance map and layer2 is applied to every center
+    hidden_size = dqn.layer1.out_features
+    net = SlidingDQN(L, hidden_size, dqn.layer2.out_features).to(dqn.layer1.weight.device)
+    with torch.no_grad():
+        net.layer1.weight.copy_(dqn.layer1.weight[:, :-1].reshape(hidden_size, 2, L, L))
+        net.layer1.bias.copy_(dqn.layer1.bias)
+        net.distance_weight.copy_(dqn.layer1.weight[:, -1])
+        net.layer2.weight.copy_(dqn.layer2.weight[:, :, None, None])
+        net.layer2.bias.copy_(dqn.layer2.bias)
+    return net
+
+def make_net(policy, n_observations, hidden_size, n_actions, Lx, Ly, L):
+ # "mlp": DQN on the L x L patches, "conv": ConvDQN on the whole (Lx x Ly) lattice
+    if policy == "conv":
+        return ConvDQN(Lx, Ly, L, hidden_size)
+    return DQN(n_observations, hidden_size, n_actions)
+
+def lattice_channels(lattices):
+ # fast and slow channels of lattices (... x Lx x Ly) as float32 (... x 2 x Lx x Ly)
+    fast = lattices == 1
+    return np.stack((fast, (lattices != 0) & ~fast), axis=-3).astype(np.float32)
+
+def whole_lattice_states(lattices):
+ # flat whole-lattice states for ConvDQN (E x Lx x Ly -> E x 2*Lx*Ly+1): fast channel, slow channel and a last entry
+ # that is not used (0), so they are stored in the replay memory as the patch states
+    E = lattices.shape[0]
+    states = np.zeros((E, 2*lattices[0].size + 1), dtype=np.float32)
+    states[:, :-1] = lattice_channels(lattices).reshape(E, -1)
+    return states
+
+class PatchExtractor(object):
+ # builds the NN input of get_state_system from periodic index tables computed once for a (Lx x Ly) system and (L x L) patches.
+ # Every call is a handful of numpy calls that write into the same preallocated float32 buffer, so nothing is allocated per move
+    def __init__(self, Lx, Ly, L):
+        self.Lx, self.Ly, self.L = Lx, Ly, L
+
+        # wrapped indices of the patch rows/columns for every center: x_table[Xcenter][i] = (Xcenter - int(L/2) + i) % Lx
+        offsets = np.arange(L) - int(L / 2)
+        self.x_table = (np.arange(Lx)[:, None] + offsets[None, :]) % Lx
+        self.y_table = (np.arange(Ly)[:, None] + offsets[None, :]) % Ly
+        # flat system index of every patch site, index_table[Xcenter, Ycenter][i*L + j] (same encoding as the actions)
+        self.index_table = (self.x_table[:, None, :, None]*Ly + self.y_table[None, :, None, :]).reshape(Lx, Ly, L*L)
+        # normalized distance of the patch to the center in the y-axis
+        self.distance_table = np.abs(np.arange(Ly) - int(Ly / 2))/int(Ly / 2)
+        # number of times a system row/column appears in the patch, x_count[Xcenter][x] (more than once only if L > Lx)
+        self.x_count = np.zeros((Lx, Lx), dtype=np.int64)
+        self.y_count = np.zeros((Ly, Ly), dtype=np.int64)
+        np.add.at(self.x_count, (np.arange(Lx)[:, None], self.x_table), 1)
+        np.add.at(self.y_count, (np.arange(Ly)[:, None], self.y_table), 1)
+        self.region_weights = {} # boundary_lane -> (upper, lower) patch masks of every Ycenter, see region_counts
+
+        self.values = np.zeros(L*L) # system values inside the patch
+        self.state = np.zeros(2*L*L + 1, dtype=np.float32)
+        self.fast_channel = self.state[:L*L]
+        self.slow_channel = self.state[L*L:2*L*L]
+        self.batch_values, self.batch_states = None, None # allocated by the first call to batch
+
+    def __call__(self, system, Xcenter, Ycenter):
+        np.take(system, self.index_table[Xcenter, Ycenter], out=self.values, mode='wrap') # 'wrap' avoids the buffered copy of mode='raise'
+        np.equal(self.values, 1, out=self.fast_channel)
+        np.not_equal(self.values, 0, out=self.slow_channel)
+        self.slow_channel -= self.fast_channel
+        self.state[-1] = self.distance_table[Ycenter]
+
+        return self.state
+
+    def batch(self, system, Xcenters, Ycenters, envs=None):
+     # same as calling the extractor for K centers at once; returns a (K x 2*L*L+1) buffer that is reused by the next call with the same K.
+     # With envs, system is a stack of lattices (E x Lx x Ly) and the k-th patch is taken from the lattice envs[k]
+        K, L2 = len(Xcenters), self.L*self.L
+        if self.batch_states is None or self.batch_states.shape[0] != K:
+            self.batch_values = np.zeros((K, L2))
+            self.batch_states = np.zeros((K, 2*L2 + 1), dtype=np.float32)
+
+        indices = self.index_table[Xcenters, Ycenters]
+        if envs is not None:
+            indices = indices + (np.asarray(envs)*self.Lx*self.Ly)[:, None]
+        np.take(system, indices, out=self.batch_values, mode='wrap')
+        np.equal(self.batch_values, 1, out=self.batch_states[:, :L2])
+        np.not_equal(self.batch_values, 0, out=self.batch_states[:, L2:2*L2])
+        self.batch_states[:, L2:2*L2] -= self.batch_states[:, :L2]
+        self.batch_states[:, -1] = self.distance_table[Ycenters]
+
+        return self.batch_states
+
+    def patch_index(self, Xcenter, Ycenter, x, y):
+     # index i*L + j of the system site (x, y) in the patch centered at (Xcenter, Ycenter), or -1 if it is outside (assumes L <= Lx, Ly)
+        i = (x - Xcenter + int(self.L / 2)) % self.Lx
+        j = (y - Ycenter + int(self.L / 2)) % self.Ly
+        if i < self.L and j < self.L:
+            return i*self.L + j
+        return -1
+
+    def multiplicity(self, Xcenter, Ycenter, x, y):
+     # number of cells of the patch centered at (Xcenter, Ycenter) that show the system site (x, y)
+        return self.x_count[Xcenter, x]*self.y_count[Ycenter, y]
+
+    def region_counts(self, state, Ycenter, boundary_lane):
+     # counts read from a state built by the extractor: fast particles of the patch in the fast region (Y < boundary_lane)
+     # and particles of any kind in the slow region (Y >= boundary_lane)
+        if boundary_lane not in self.region_weights:
+            upper = (self.y_table < boundary_lane).astype(np.float32)
+            self.region_weights[boundary_lane] = (np.tile(upper, self.L), np.tile(1 - upper, self.L)) # cell i*L + j has the row of column j
+        upper, lower = self.region_weights[boundary_lane]
+        L2 = self.L*self.L
+        fast_up = np.dot(state[:L2], upper[Ycenter])
+        all_down = np.dot(state[:L2], lower[Ycenter]) + np.dot(state[L2:2*L2], lower[Ycenter])
+
+        return int(fast_up), int(all_down)
+
+patch_extractors = {} # one PatchExtractor per (Lx, Ly, L)
+
 def get_state_system(system, Lx, Ly, Xcenter, Ycenter, L):
  # creates the input for the NN from the system (Lx x Ly)
  # the state consists on two channels: two patches (fast and slow particles) taken from the system with dimensions (L x L) and centered at (Xcenter, Ycenter),
  # and a number that indicates the distance of the patch to the center in the y-axis.
-    
-    # defining the training patch
-    fast_channel = np.zeros(shape=(L,L)) 
-    slow_channel = np.zeros(shape=(L,L)) 
-
-    # calculate the index offsets of the patch from the center of the system
-    x_offset = Xcenter - int(L / 2)
-    y_offset = Ycenter - int(L / 2)
-    for i in range(L):
-        x_index = x_offset + i
-        x_index = x_index % Lx # periodic boundaries
-        
-        for j in range(L):
-            y_index = y_offset + j
-            y_index = y_index % Ly # periodic boundaries
-
-            value = system[x_index][y_index]
-            if value == 1:
-                fast_channel[i][j] = 1
-            elif value != 0:
-                slow_channel[i][j] = 1
-                
-    patch = np.concatenate((fast_channel, slow_channel), axis= None)
-    distance_center = abs(Ycenter - int(Ly / 2))/int(Ly / 2) # normalized
-    state = np.append(patch, distance_center)
-
-    return state
+ # The returned array is the buffer of the extractor and it is overwritten by the next call, copy it (e.g. torch.tensor) to keep it
+    extractor = patch_extractors.get((Lx, Ly, L))
+    if extractor is None:
+        extractor = PatchExtractor(Lx, Ly, L)
+        patch_extractors[(Lx, Ly, L)] = extractor
+
+    return extractor(system, Xcenter, Ycenter)
 
 def get_coordinates_from_patch(x, y, Xcenter, Ycenter, L, Lx, Ly):
  # translates the lattice site (x, y) from the patch to the system reference (x_sys, y_sys)
@@ -100,168 +371,112 @@ def get_coordinates_from_patch(x, y, Xcenter, Ycenter, L, Lx, Ly):
     return x_sys, y_sys    
 
 
-def is_patch_crossing_boundary(Y_boundary, Ycenter, L, Ly):
-    half_L = int(L / 2)
-    distance = abs(Y_boundary - Ycenter)
+def exploration(explore_dice):
+ # which environments explore in this step, from their pre-drawn samples (uniform [0, 1)); every environment counts as one step of the epsilon decay
+    global steps_done
+    n_envs = len(explore_dice)
+    eps_threshold = EPS_END + (EPS_START - EPS_END) * np.exp(-1. * (steps_done + np.arange(n_envs)) / EPS_DECAY)
+    steps_done += n_envs
+    return torch.as_tensor(explore_dice <= eps_threshold, device=device)
 
-    if min(distance, Ly - distance) <= half_L:
-        return True
-    else:
-        return False
+def select_actions_training(states, explore_dice, rand_actions):
+ # epsilon-greedy selection for a batch of states (one per environment) with a single network call;
+ # every environment has its pre-drawn exploration sample and random action (random lattice site in
+ # the observation patch), see draw_sweep
+    n_envs = states.shape[0]
+    explore = exploration(explore_dice)
+    rand_actions = torch.as_tensor(rand_actions, device=device)
 
-def select_action_training(state): 
-    global steps_done # count total number of steps to go from almost random exploration to more efficient actions
-    sample = random.random()
-    eps_threshold = EPS_END + (EPS_START - EPS_END) * math.exp(-1. * steps_done / EPS_DECAY)
-    steps_done += 1
-    
-    if sample > eps_threshold: # exploitation
-        with torch.no_grad():
-            return policy_net(state).max(1)[1].view(1, 1) # view(1,1) changes shape to [[action], dtype]
-    else:
-        # select a random action
-        rand_action = random.randint(0,L*L-1) # random lattice site in the observation patch
-        return torch.tensor([[rand_action]], device=device, dtype=torch.long)
-
-def select_action_post_training(state): 
-    # interpret Q values as probabilities when simulating dynamics of the system 
-    # in principle this could be easily extended to make this more general, but i am a lazy boi
     with torch.no_grad():
-        # print("state ", state)
-        Q_values = trained_net(state)
-        # print("Q-values ", Q_values)
-        probs = torch.softmax(Q_values, dim=1) # converts logits to probabilities (torch object)
-        # print("probs ", probs)
-        dist = Categorical(probs) # feeds torch object to generate a list of probs (numpy object ?)
-        # print("dist ", dist)
-        action = dist.sample().numpy()[0] # sample list of probs and return the action
+        actions = acting_net(states).max(1)[1]
+    return torch.where(explore, rand_actions, actions).view(n_envs, 1)
+
+def select_sites_training(Q_values, taken, explore_dice, rand_actions):
+ # epsilon-greedy selection of lattice sites for ConvDQN from the Q maps (n_envs x Lx*Ly) computed once for a block of moves:
+ # the greedy choice is the best site not taken yet in the block (taken is updated), so a block of K moves takes the K best sites
+    n_envs = Q_values.shape[0]
+    explore = exploration(explore_dice)
+    rand_actions = torch.as_tensor(rand_actions, device=device)
+
+    actions = Q_values.masked_fill(taken, -math.inf).max(1)[1]
+    actions = torch.where(explore, rand_actions, actions)
+    taken[torch.arange(n_envs, device=device), actions] = True
+    return actions.view(n_envs, 1)
+
+def select_actions_post_training(states, net, uniforms):
+ # interpret Q values as probabilities when simulating dynamics of the system
+ # the K states (K x 2L*L+1) are evaluated in a single forward pass and all K actions are drawn at once with the Gumbel-max trick:
+ # argmax(Q + G), with G = -log(-log(U)), samples each row from softmax(Q) as Categorical(probs).sample() does.
+ # The uniforms U (K x L*L, in [0, 1)) are pre-drawn by the caller
+    with torch.no_grad():
+        return sample_actions(net(states), uniforms)
 
-        return action
+def sample_actions(Q_values, uniforms):
+ # Gumbel-max sampling of one action per row of Q_values (K x n_actions) from softmax(Q), with the pre-drawn uniforms (K x n_actions)
+    with torch.no_grad():
+        uniforms = torch.as_tensor(uniforms, dtype=Q_values.dtype, device=Q_values.device)
+        gumbel = -torch.log(-torch.log(uniforms))
+        actions = (Q_values + gumbel).argmax(dim=1)
+
+        return actions.cpu().numpy()
+
+def draw_sweep(rng, Lx, Ly, n_actions):
+ # random numbers of one training sweep (Lx*Ly move attempts) of an environment, drawn at once as (Lx*Ly,) blocks
+ # that are consumed by index: patch centers, exploration samples, random actions (0 to n_actions-1), jump directions (0-3) and jump dice
+    n_moves = Lx*Ly
+    Xcenters = rng.integers(0, Lx, n_moves)
+    Ycenters = rng.integers(0, Ly, n_moves)
+    explore_dice = rng.random(n_moves)
+    rand_actions = rng.integers(0, n_actions, n_moves)
+    directions = rng.integers(0, 4, n_moves)
+    jump_dice = rng.random(n_moves)
+    return Xcenters, Ycenters, explore_dice, rand_actions, directions, jump_dice
 
 # move
-def step(lattice, X, Y, L, Xcenter, Ycenter, boundary_lane, log = False):
-    newX = -1
-    newY = -1
-    # periodic boundaries
+def step(lattice_state, X, Y, L, Xcenter, Ycenter, reward_function, direction, jump_dice, log = False):
+    lattice = lattice_state.lattice
     Lx, Ly = lattice.shape
-    nextX = X + 1 if X < Lx - 1 else 0
-    prevX = X - 1 if X > 0 else Lx - 1
-    nextY = Y + 1 if Y < Ly - 1 else 0
-    prevY = Y - 1 if Y > 0 else Ly - 1
-
-    # update position
-    direction = random.randint(0,3)
-    if direction == 0 or direction == 1: # jump right
-        newX = nextX
-        newY = Y
-    elif direction == 2: # jump up
-        newY = nextY
-        newX = X
-    else: # jump down
-        newY = prevY
-        newX = X
+
+    # update position (compiled exclusion move), with the pre-drawn direction and dice
+    speed = lattice[X][Y]
+    newX, newY, move = lattice_state.jump(X, Y, direction, jump_dice)
+    if move == NO_MOVE: # the particle stays at (X, Y)
+        newX, newY = X, Y
 
     current_along = 0
     reward = 1 # simply for choosing a particle and not an empty space
-    speed = lattice[X][Y]
-    jump_dice = random.random()
-    if jump_dice <= speed:
-        if lattice[newX][newY] == 0: # next site free
-            lattice[X][Y] = 0
-            lattice[newX][newY] = speed     
-            if newX != X: # we have jump forward
-                current_along = 1
-                reward += 1
-        else:          
-            if log == True:
-                print("  obstacle: it couldn't jump :(")                         
-    else:
-        if log == True:
+    if move == MOVE_FORWARD: # we have jump forward
+        current_along = 1
+    elif move == NO_MOVE and log == True:
+        if jump_dice <= speed:
+            print("  obstacle: it couldn't jump :(")
+        else:
             print("  no speed: it couldn't jump :(")
 
- # surroundings reward (before jump)
-    if lattice[nextX][Y] == 0:
-        forward_particle = 0
-    else:
-        forward_particle = 1
-
-    reward += int(- 1*(2*forward_particle - 1))   
-
- # lanes rewards (before jump)
-    # extracts a vector with the columns of the patch
-    half_patch = int(L/2)
-    start_idx = (Xcenter - half_patch) % Lx
-    end_idx = (Xcenter + half_patch + 1) % Lx
-    if start_idx < end_idx:
-        patch_columns = lattice[start_idx:end_idx, :]
-    else:
-        patch_columns = np.concatenate((lattice[start_idx:Lx, :], lattice[0:end_idx, :]), axis=0)
-
-    for boundary in [boundary_lane, (boundary_lane-1), 0, (Ly-1)]:
-        if is_patch_crossing_boundary(boundary, Ycenter, L, Ly):
-            particles_boundary = patch_columns[:, boundary]
-            if speed == 1:
-                if boundary == boundary_lane or boundary == (Ly-1):
-                    if Y == boundary:
-                        reward += 5
-                    elif Y > boundary_lane and np.any(particles_boundary == speed): # slow region
-                        reward += -1
-                    elif Y < boundary_lane and np.any(particles_boundary == speed): # fast region
-                        reward += -5
-
-                elif boundary == 0 or boundary == (boundary_lane-1):
-                    if Y == boundary:
-                        reward += 0                                   
-                    elif Y >= boundary_lane and np.any(particles_boundary == speed): # slow region
-                        reward += -1
-                    elif Y < boundary_lane and np.any(particles_boundary == speed): # fast region
-                        reward += -5
-
-            elif speed == 0.8:
-                if boundary == (boundary_lane-1) or boundary == 0:
-                    if Y == boundary:
-                        reward += 5                                
-                    elif Y < boundary_lane and np.any(particles_boundary == speed): # fast region
-                        reward += -1
-                    elif Y >= boundary_lane and np.any(particles_boundary == speed): # slow region
-                        reward += -5
-
-                elif boundary == boundary_lane or boundary == (Ly-1):
-                    if Y == boundary:
-                        reward += 0                                    
-                    elif Y > boundary_lane and np.any(particles_boundary == speed): # slow region
-                        reward += -1
-                    elif Y < boundary_lane and np.any(particles_boundary == speed): # fast region
-                        reward += -5                      
+ # weighted reward components (forward jump, surroundings, lanes...), evaluated on the lattice after the move, see rewards.py
+    reward += reward_function.single(lattice_state, speed, X, Y, newX, newY, move, Xcenter, Ycenter)
 
     next_state = get_state_system(lattice, Lx, Ly, Xcenter, Ycenter, L)
 
-    return reward, next_state, current_along
+    return reward, next_state, current_along, newX, newY
 
 def optimize_model():
     if len(memory) < BATCH_SIZE: # execute 'optimize_model' only if #BATCH_SIZE number of updates have happened 
         return
-    transitions = memory.sample(BATCH_SIZE) # draws a random set of transitions; the next_state for terminal transition will be NONE
-    # Transpose the batch (see https://stackoverflow.com/a/19343/3343043 for detailed explanation). This converts batch-array of Transitions
-    # to Transition of batch-arrays.
-    batch = Transition(*zip(*transitions)) # turn [transition, (args)] array into [[transitions], [states], [actions], ... ]
-
-    # Compute a mask of non-final states and concatenate the batch elements (a final state would've been the one after which simulation ended)
-    non_final_mask = torch.tensor(tuple(map(lambda s: s != None, batch.next_state)), device=device, dtype=torch.bool) # returns a set of booleans
-    non_final_next_states = torch.cat([s for s in batch.next_state if s is not None]) # creates a list of non-empty next states
-    state_batch = torch.cat(batch.state)
-    action_batch = torch.cat(batch.action)
-    reward_batch = torch.cat(batch.reward)
+    batch = memory.sample(BATCH_SIZE) # draws a random set of transitions, already stacked as [states, actions, next_states, rewards] tensors
+    state_batch = batch.state
+    action_batch = batch.action
+    reward_batch = batch.reward
 
     # Policy_net produces [[Q1,...,QN], ...,[]] (BATCH x N)-sized matrix, where N is the size of action space, 
     # and action_batch is BATCH-sized vector whose values are the actions that have been taken. 
     # Gather tells which Q from [Q1,...,QN] row to take, using action_batch vector, and returns BATCH-sized vector of Q(s_t, a) values
     state_action_values = policy_net(state_batch).gather(1, action_batch) # input = policy_net, dim = 1, index = action_batch
 
-    # Compute Q^\pi(s_t,a) values of actions for non_final_next_states by using target_net (old policy_net), from which max_a{Q(s_t, a)} are selected with max(1)[0].
-    next_state_values = torch.zeros(BATCH_SIZE, device=device)
+    # Compute Q^\pi(s_t,a) values of actions for the next states by using target_net (old policy_net), from which max_a{Q(s_t, a)} are selected with max(1)[0].
+    # There are no final states in the simulation, so every transition has a next state
     with torch.no_grad():
-        next_state_values[non_final_mask] = target_net(non_final_next_states).max(1)[0] # target_net produces a vector of Q^pi(s_t+1,a)'s and max(1)[0] takes maxQ
+        next_state_values = target_net(batch.next_state).max(1)[0] # target_net produces a vector of Q^pi(s_t+1,a)'s and max(1)[0] takes maxQ
     # Compute the expected Q^pi(s_t,a) values for all BATCH_SIZE (default=128) transitions
     expected_state_action_values = (next_state_values * GAMMA) + reward_batch
 
@@ -274,18 +489,115 @@ def optimize_model():
     torch.nn.utils.clip_grad_value_(policy_net.parameters(), 100)
     optimizer.step()
 
-def do_training(num_episodes, L, density, Nt, Lx, Ly, boundary_lane, log = False):
+def update_target_net(target_net, policy_net, tau):
+ # soft update of the target network's weights in place, θ′ ← τ θ + (1 −τ)θ′, with one fused lerp over all the parameters.
+ # tau = 1 is a hard copy of the policy network
+    with torch.no_grad():
+        target_params = list(target_net.parameters())
+        policy_params = list(policy_net.parameters())
+        if tau == 1:
+            for target_param, policy_param in zip(target_params, policy_params):
+                target_param.copy_(policy_param)
+        else:
+            torch._foreach_lerp_(target_params, policy_params, tau)
+
+def learning_step(step_count):
+ # one optimisation of the policy network followed by the update of the target network:
+ # soft θ′ ← τ θ + (1 −τ)θ′ after every step, or a hard copy every HARD_UPDATE steps
+    optimize_model()
+    if HARD_UPDATE == 0:
+        update_target_net(target_net, policy_net, TAU)
+    elif step_count % HARD_UPDATE == 0:
+        update_target_net(target_net, policy_net, 1)
+
+class Learner(threading.Thread):
+ # runs the learning steps in a background thread. Only the parts that release the GIL overlap with the simulation:
+ # the torch operations and the compiled (nogil) kernels of tasep_kernels and rewards; the Python loops hold it.
+ # The simulation asks for one learning step per Nt step (same ratio of updates to transitions as the synchronous loop)
+ # and waits when max_pending steps are still to do, so the acting network never falls further behind;
+ # every publish_every steps the learner publishes a copy of the policy network as the acting network used to choose actions.
+ # An exception of a learning step stops the thread and is raised again in the simulation by request_step or stop
+    def __init__(self, publish_every, max_pending):
+        super(Learner, self).__init__(daemon=True)
+        self.publish_every = publish_every
+        self.requests = queue.Queue(maxsize=max_pending)
+        self.updates = 0
+        self.error = None
+        self.publish()
+
+    def publish(self):
+        global acting_net
+        acting_net = copy.deepcopy(policy_net) # the reference swap is atomic, the simulation never sees a half-updated network
+
+    def request_step(self, step_count):
+        self.put(step_count)
+
+    def put(self, request):
+     # blocks while the queue is full, checking that the learner is still alive
+        while True:
+            self.check()
+            try:
+                self.requests.put(request, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("learning step failed in the learner thread") from self.error
+
+    def run(self):
+        try:
+            while True:
+                step_count = self.requests.get()
+                if step_count is None:
+                    break
+                learning_step(step_count)
+                self.updates += 1
+                if self.updates % self.publish_every == 0:
+                    self.publish()
+        except BaseException as error:
+            self.error = error
+
+    def stop(self):
+     # finishes the pending learning steps and publishes the final weights
+        self.put(None)
+        self.join()
+        self.check()
+        self.publish()
+
+def seed_sequence(seed):
+ # SeedSequence from an int, None (fresh entropy from the OS) or an existing SeedSequence;
+ # independent streams are obtained with seed_sequence(seed).spawn(n)
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+def do_training(num_episodes, L, density, Nt, Lx, Ly, boundary_lane, log = False, seed = None):
+ # every episode and environment has its own random stream spawned from seed
+    if memory.store_moves and policy != "conv" and (L > Lx or L > Ly):
+        raise ValueError("store_moves needs patches that fit in the system (L <= Lx and L <= Ly)")
+    learner = None
+    if ASYNC_LEARNER: # optimisation in a background thread, see Learner
+        learner = Learner(PUBLISH_EVERY, MAX_PENDING)
+        learner.start()
+
+    episode_seeds = seed_sequence(seed).spawn(num_episodes)
     for i_episode in tqdm(range(num_episodes)):
-        # start with random initial conditions
-        N = int(Lx*Ly*density) 
-        lattice = np.zeros(shape=(Lx,Ly))
-        n = 0
-        while n < N:
-            X = random.randint(0, Lx-1)
-            Y = random.randint(0, Ly-1)
-            if lattice[X][Y] == 0:
-                lattice[X][Y] = Random.choice([0.8, 1], p =[0,1])
-                n += 1
+        # start with random initial conditions, n_envs independent lattices stepped in lockstep
+        rngs = [np.random.default_rng(env_seed) for env_seed in episode_seeds[i_episode].spawn(n_envs)]
+        lattices = np.zeros(shape=(n_envs,Lx,Ly))
+        lattice_states = []
+        for e in range(n_envs):
+            lattices[e] = initial_lattice(rngs[e], Lx, Ly, density, fast_fraction, init)
+            lattice = lattices[e] # view: the moves done on the lattice state show up in lattices
+            lattice_states.append(LatticeState(lattice, boundary_lane, L)) # keeps the occupancy counters of the regions
+        extractor = PatchExtractor(Lx, Ly, L)
+        reward_function = Reward(reward_weights, Lx, Ly, L, boundary_lane)
+        conv = policy == "conv" # whole-lattice states and actions, the patch of the rewards is centered at the selected site
+        n_sites = Lx*Ly if conv else L*L
+        envs = np.arange(n_envs)
+        samples = Lx*Ly*Nt*n_envs # move attempts in the episode, over all environments
 
         # main update loop; I use Monte Carlo random sequential updates here
         score = 0
@@ -296,102 +608,114 @@ def do_training(num_episodes, L, density, Nt, Lx, Ly, boundary_lane, log = False
         right_fast, right_slow = 0, 0         
 
         for t in range(Nt):
+            # random numbers of the whole sweep, (n_envs x Lx*Ly) blocks
+            sweep = [np.stack(block) for block in zip(*[draw_sweep(rng, Lx, Ly, n_sites) for rng in rngs])]
+            sweep_Xcenters, sweep_Ycenters, explore_dice, rand_actions, directions, jump_dice = sweep
             for i in range(Lx*Ly):
-                total_fast, fast_up  = 0, 0
-                total_slow, slow_down = 0, 0
-                before_fast, after_fast = 0, 0
-                before_slow, after_slow = 0, 0
-                # random sampling in the lattice to apply the training
-                Xcenter = random.randint(0, Lx-1)
-                Ycenter = random.randint(0, Ly-1)
-
-                # counting particles in the patch before jumping
-                for i in range(L):
-                    for j in range(L):
-                        X_sys, Y_sys = get_coordinates_from_patch(i, j, Xcenter, Ycenter, L, Lx, Ly)
-                        if lattice[X_sys][Y_sys] == 1 and Y_sys < boundary_lane:
-                            before_fast += 1
-                        elif lattice[X_sys][Y_sys] != 0 and Y_sys >= boundary_lane:
-                            before_slow += 1                
-
-                state = get_state_system(lattice, Lx, Ly, Xcenter, Ycenter, L)
-                state = torch.tensor(state, dtype=torch.float32, device=device).unsqueeze(0)
-
-                action = select_action_training(state) # get the index of the particle
-                lattice_site = action.item() # a number, and we encode it as x*L + y
-                patchX = int(lattice_site / L)
-                patchY = int(lattice_site % L)
-                selectedX, selectedY = get_coordinates_from_patch(patchX, patchY, Xcenter, Ycenter, L, Lx, Ly)
-                                                                                                                              
-                if lattice[selectedX][selectedY] != 0:
-                    # counting of selected fast and slow particles
-                    if lattice[selectedX][selectedY] == 1:
-                        selected_fast += 1
+                if conv:
+                    states = torch.tensor(whole_lattice_states(lattices), device=device)
+                    if i % CONV_REFRESH == 0: # one forward pass scores the sites of all the lattices for the next CONV_REFRESH moves
+                        with torch.no_grad():
+                            Q_values = acting_net(states)
+                        taken = torch.zeros(Q_values.shape, dtype=torch.bool, device=device)
+                    actions = select_sites_training(Q_values, taken, explore_dice[:, i], rand_actions[:, i]) # index X*Ly + Y of the site
+                    Xcenters, Ycenters = np.divmod(actions.cpu().numpy().ravel(), Ly)
+                else:
+                    # random sampling in each lattice to apply the training
+                    Xcenters = sweep_Xcenters[:, i]
+                    Ycenters = sweep_Ycenters[:, i]
+
+                    batch_states = extractor.batch(lattices, Xcenters, Ycenters, envs)
+                    states = torch.tensor(batch_states, dtype=torch.float32, device=device)
+                    actions = select_actions_training(states, explore_dice[:, i], rand_actions[:, i]) # get the index of the particle, one network call for all the environments
+
+                for e in range(n_envs):
+                    lattice_state, lattice = lattice_states[e], lattices[e]
+                    Xcenter, Ycenter = Xcenters[e], Ycenters[e]
+                    state, action = states[e:e+1], actions[e:e+1]
+                    lattice_site = action.item() # a number, and we encode it as x*L + y (X*Ly + Y for the whole lattice)
+                    if conv:
+                        selectedX, selectedY = Xcenter, Ycenter
                     else:
-                        selected_slow += 1                    
-                    # update particle's position and do stochastic part                                         
-                    reward, next_state, current_along = step(lattice, selectedX, selectedY, L, Xcenter, Ycenter, boundary_lane, log) 
-                    total_current += current_along / (Lx*Ly*Nt)
-                    reward = torch.tensor([reward], device=device)
-                    next_state = torch.tensor(next_state, dtype=torch.float32, device=device).unsqueeze(0) 
-                    memory.push(state, action, next_state, reward)
-                    
-                    
-                else: # empty site chosen
-                    reward = -10
-                    selected_empty_site += 1
-                    reward = torch.tensor([reward], device=device)  
-                    memory.push(state, action, state, reward)
-
-                # counting particles in the patch after jumping
-                for i in range(L):
-                    for j in range(L):
-                        X_sys, Y_sys = get_coordinates_from_patch(i, j, Xcenter, Ycenter, L, Lx, Ly)
-                        if lattice[X_sys][Y_sys] == 1 and Y_sys < boundary_lane:
-                            after_fast += 1
-                        elif lattice[X_sys][Y_sys] != 0 and Y_sys >= boundary_lane:
-                            after_slow += 1   
-
-                score += reward
-
-                # counting particles in their respective areas
-                for i in range(Lx):
-                    for j in range(Ly):
-                        if lattice[i][j] == 1:
-                            total_fast += 1
-                            if j < boundary_lane:
-                                fast_up += 1
-                        elif lattice[i][j] != 0: 
-                            total_slow += 1
-                            if j >= boundary_lane:
-                                slow_down += 1
-                right_fast += fast_up / total_fast if total_fast != 0 else 0
-                right_slow += slow_down / total_slow if total_slow != 0 else 0
-
-            optimize_model()
-            # Soft update of the target network's weights: θ′ ← τ θ + (1 −τ)θ′
-            target_net_state_dict = target_net.state_dict()
-            policy_net_state_dict = policy_net.state_dict()
-            for key in policy_net_state_dict:
-                target_net_state_dict[key] = policy_net_state_dict[key]*TAU + target_net_state_dict[key]*(1-TAU)
-            target_net.load_state_dict(target_net_state_dict)
-
-        print("Training episode ", i_episode, " is over. Current = ", total_current, "; Selected empty sites / L*L = ", selected_empty_site / (Lx*Ly*Nt))             
-        print("Fast particles chosen ", selected_fast/ (Lx*Ly*Nt), ". Slow particles chosen = ", selected_slow / (Lx*Ly*Nt))
-        print("Fast particles in the upper side ", right_fast/ (Lx*Ly*Nt), ". Slow particles in the lower side = ", right_slow / (Lx*Ly*Nt))
+                        # counting particles in the patch before jumping, read from the state
+                        before_fast, before_slow = extractor.region_counts(batch_states[e], Ycenter, boundary_lane)
+                        after_fast, after_slow = before_fast, before_slow
+
+                        patchX = int(lattice_site / L)
+                        patchY = int(lattice_site % L)
+                        selectedX, selectedY = get_coordinates_from_patch(patchX, patchY, Xcenter, Ycenter, L, Lx, Ly)
+                                                                                                                                  
+                    if lattice[selectedX][selectedY] != 0:
+                        # counting of selected fast and slow particles
+                        if lattice[selectedX][selectedY] == 1:
+                            selected_fast += 1
+                        else:
+                            selected_slow += 1                    
+                        # update particle's position and do stochastic part                                         
+                        speed = lattice[selectedX][selectedY]
+                        reward, next_state, current_along, newX, newY = step(lattice_state, selectedX, selectedY, L, Xcenter, Ycenter, reward_function, directions[e, i], jump_dice[e, i], log) 
+
+                        # counting particles in the patch after jumping: only the moved particle can change the counts
+                        if not conv and (newX, newY) != (selectedX, selectedY):
+                            old_cells = extractor.multiplicity(Xcenter, Ycenter, selectedX, selectedY)
+                            new_cells = extractor.multiplicity(Xcenter, Ycenter, newX, newY)
+                            if speed == 1:
+                                after_fast += new_cells*(newY < boundary_lane) - old_cells*(selectedY < boundary_lane)
+                            after_slow += new_cells*(newY >= boundary_lane) - old_cells*(selectedY >= boundary_lane)
+                        total_current += current_along / samples
+                        reward = torch.tensor([reward], device=device)
+                        if memory.store_moves: # only the patch indices of the move are stored
+                            if (newX, newY) != (selectedX, selectedY):
+                                move = (lattice_site, newX*Ly + newY if conv else extractor.patch_index(Xcenter, Ycenter, newX, newY))
+                            else:
+                                move = (-1, -1)
+                            memory.push_move(state, action, move, reward)
+                        else:
+                            if conv: # the whole lattice after the move
+                                next_state = whole_lattice_states(lattice[None])[0]
+                            next_state = torch.tensor(next_state, dtype=torch.float32, device=device).unsqueeze(0) 
+                            memory.push(state, action, next_state, reward)
+                        
+                        
+                    else: # empty site chosen
+                        reward = -10
+                        selected_empty_site += 1
+                        reward = torch.tensor([reward], device=device)  
+                        if memory.store_moves:
+                            memory.push_move(state, action, (-1, -1), reward)
+                        else:
+                            memory.push(state, action, state, reward)
+
+                    score += reward / n_envs # mean score of the environments
+
+                    # particles in their respective areas (counters updated on every jump)
+                    right_fast += lattice_state.right_fast()
+                    right_slow += lattice_state.right_slow()
+
+            # optimisation of the policy network and update of the target network
+            if learner is not None:
+                learner.request_step(i_episode*Nt + t + 1)
+            else:
+                learning_step(i_episode*Nt + t + 1)
+
+        print("Training episode ", i_episode, " is over. Current = ", total_current, "; Selected empty sites / L*L = ", selected_empty_site / samples)             
+        print("Fast particles chosen ", selected_fast/ samples, ". Slow particles chosen = ", selected_slow / samples)
+        print("Fast particles in the upper side ", right_fast/ samples, ". Slow particles in the lower side = ", right_slow / samples)
 
         rewards.append(score.numpy()) 
         current.append(total_current)
 
-        empty_sites.append(selected_empty_site / (Lx*Ly*Nt))
-        fast_chosen.append(selected_fast / (Lx*Ly*Nt))
-        slow_chosen.append(selected_slow / (Lx*Ly*Nt))
-        fast_sites.append(right_fast / (Lx*Ly*Nt))
-        slow_sites.append(right_slow / (Lx*Ly*Nt))
+        empty_sites.append(selected_empty_site / samples)
+        fast_chosen.append(selected_fast / samples)
+        slow_chosen.append(selected_slow / samples)
+        fast_sites.append(right_fast / samples)
+        slow_sites.append(right_slow / samples)
 
         plot_score() # here if you want to see the training
                      # only with interactive python
 
+    if learner is not None:
+        learner.stop()
     torch.save(target_net.state_dict(), PATH)
     plot_score(show_result=True) # here to see the result
     plt.savefig(f"./Training_Reward_{Lx}x{Ly}.png", format="png", dpi=600)
@@ -405,6 +729,153 @@ def do_training(num_episodes, L, density, Nt, Lx, Ly, boundary_lane, log = False
     plt.savefig(f"./Training_Particle_Occupation{Lx}x{Ly}.png", format="png", dpi=600) 
 
 # plots
+# species codes of the movie frames
+MOVIE_EMPTY = 0
+MOVIE_SLOW = 1
+MOVIE_FAST = 2
+
+class MovieRecorder(object):
+ # frames of the lattice written during a run to a memory-mapped .npy file (standard header: uint8, shape (frames, Ly, Lx),
+ # already transposed for imshow) with one code per site, MOVIE_EMPTY, MOVIE_SLOW or MOVIE_FAST. The initial lattice is frame 0
+ # and then one frame every stride move attempts, so the memory does not grow with the length of the recording
+    def __init__(self, path, lattice, Nt, stride):
+        Lx, Ly = lattice.shape
+        self.frames = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=((Lx*Ly*Nt)//stride + 1, Ly, Lx))
+        self.stride = stride
+        self.next_frame = 0
+        self.record(lattice, 0)
+
+    def record(self, lattice, attempts):
+     # writes the frames due after the given number of move attempts since the start. Moves applied in blocks
+     # only give the lattice at the end of the block, which is exact when stride is a multiple of the block size
+        while self.next_frame < len(self.frames) and self.next_frame*self.stride <= attempts:
+            self.frames[self.next_frame] = np.where(lattice == 0, MOVIE_EMPTY, np.where(lattice == 1, MOVIE_FAST, MOVIE_SLOW)).T
+            self.next_frame += 1
+
+    def close(self):
+        self.frames.flush()
+        del self.frames
+
+def post_training_run(seed, net, Lx, Ly, L, Nt, density, boundary_lane, K, random_baseline, init = "random", fast_fraction = 1., log = False,
+                      kinetic = False, movie_stride = 1, movie = None):
+ # one independent post-training run, with its own random stream (seed is an int or a SeedSequence) and network.
+ # Returns the per-sweep counts (Nt) of forward jumps, selected empty sites, fast and slow particles, the sums of the
+ # fractions of particles in their regions, and the per-row (Ly) counts of parallel and perpendicular jumps of both species.
+ # kinetic (random_baseline only) runs the rejection-free continuous-time dynamics of KineticState, binned per unit of time (sweep).
+ # With a movie path the run is recorded there, one frame every movie_stride move attempts (see MovieRecorder)
+    if kinetic and not random_baseline:
+        raise ValueError("the kinetic dynamics is only available for the random baseline")
+    rng = np.random.default_rng(seed)
+    extractor = PatchExtractor(Lx, Ly, L)
+
+    current = np.zeros(Nt)
+    empty_sites = np.zeros(Nt)
+    fast_chosen = np.zeros(Nt)    
+    slow_chosen = np.zeros(Nt)
+    fast_sites = np.zeros(Nt)      # fast particles in the right region
+    slow_sites = np.zeros(Nt)
+    YcurrentII_fast = np.zeros(Ly) # parallel current for fast particles
+    YcurrentII_slow = np.zeros(Ly) 
+    YcurrentT_fast = np.zeros(Ly)  # perpendicular current for fast particles
+    YcurrentT_slow = np.zeros(Ly)
+
+    # start with random initial conditions
+    lattice = initial_lattice(rng, Lx, Ly, density, fast_fraction, init)
+    if kinetic:
+        lattice_state = KineticState(lattice, boundary_lane) # also keeps the sets of possible jumps
+    else:
+        lattice_state = LatticeState(lattice, boundary_lane) # keeps the occupancy counters of the regions
+    recorder = MovieRecorder(movie, lattice, Nt, movie_stride) if movie is not None else None
+
+    for t in range(Nt):
+        if kinetic: # only the successful jumps of one unit of time; the Lx*Ly uniform picks of a sweep are counted by their expected values
+            forward, transverse, region_time = lattice_state.advance(rng, 1.)
+            fast_chosen[t] = lattice_state.counts[0]
+            slow_chosen[t] = lattice_state.counts[2]
+            empty_sites[t] = Lx*Ly - fast_chosen[t] - slow_chosen[t]
+            current[t] = forward.sum()
+            YcurrentII_fast += forward[0]
+            YcurrentII_slow += forward[1]
+            YcurrentT_fast += transverse[0]
+            YcurrentT_slow += transverse[1]
+            fast_sites[t] = Lx*Ly*region_time[0] # time average of the fractions, weighted as Lx*Ly move attempts
+            slow_sites[t] = Lx*Ly*region_time[1]
+            if recorder is not None:
+                recorder.record(lattice, (t + 1)*Lx*Ly)
+            continue
+
+        # random numbers of the whole sweep (Lx*Ly move attempts), consumed block by block
+        sweep_X = rng.integers(0, Lx, Lx*Ly) # selected sites (random_baseline) or patch centers
+        sweep_Y = rng.integers(0, Ly, Lx*Ly)
+        if isinstance(net, ConvDQN) and not random_baseline:
+            sweep_uniforms = rng.random(Lx*Ly) # one per move, for the inverse transform sampling of the site from the whole lattice
+        elif not random_baseline:
+            sweep_uniforms = rng.random((Lx*Ly, L*L)) # for the Gumbel-max sampling of the actions
+        sweep_directions = rng.integers(0, 4, Lx*Ly)
+        sweep_jump_dice = rng.random(Lx*Ly)
+
+        for block_start in range(0, Lx*Ly, K):
+           # Random sampling of K patch centers of the lattice; their states are evaluated together
+           # and the K moves are applied in sequence, so the states lag at most K-1 moves behind the lattice
+            block = slice(block_start, block_start + K)
+            if random_baseline: # random "stupid" simulation: the sites are picked uniformly, no NN involved
+                selectedX = sweep_X[block]
+                selectedY = sweep_Y[block]
+            elif isinstance(net, ConvDQN): # the K sites are sampled from softmax(Q) of the whole lattice, one forward pass
+                with torch.no_grad():
+                    Q_values = net.q_map(torch.tensor(lattice_channels(lattice[None]), device=device)).flatten()
+                cumulative = torch.softmax(Q_values.double(), dim=0).cumsum(0).cpu().numpy()
+                sites = np.searchsorted(cumulative, sweep_uniforms[block]*cumulative[-1], side='right')
+                selectedX, selectedY = np.divmod(np.minimum(sites, Lx*Ly - 1), Ly)
+            else:
+                Xcenters = sweep_X[block]
+                Ycenters = sweep_Y[block]
+
+                if isinstance(net, SlidingDQN): # the Q values of the K patches are read from one pass on the whole lattice
+                    actions = sample_actions(net.patch_q_values(lattice, Xcenters, Ycenters), sweep_uniforms[block])
+                else:
+                    states = extractor.batch(lattice, Xcenters, Ycenters)
+                    states = torch.tensor(states, dtype=torch.float32, device=device)
+                    actions = select_actions_post_training(states, net, sweep_uniforms[block]) # numbers, and we encode them as x*L + y
+                selectedX = extractor.x_table[Xcenters, actions // L] # patch to system coordinates
+                selectedY = extractor.y_table[Ycenters, actions % L]
+
+            directions = sweep_directions[block]
+            jump_dice = sweep_jump_dice[block]
+            speeds, moves, right_fast, right_slow = lattice_state.apply_moves(selectedX, selectedY, directions, jump_dice)
+
+            # counting of selected fast, slow particles and empty sites
+            fast = speeds == 1
+            slow = (speeds != 0) & ~fast
+            fast_chosen[t] += np.count_nonzero(fast)
+            slow_chosen[t] += np.count_nonzero(slow)
+            empty_sites[t] += np.count_nonzero(speeds == 0)
+            if log == True and np.any(speeds == 0):
+                print("ALARM! ALARM!")
+                print("empty site chosen")
+
+            # currents along and perpendicular to the driving direction, per row of the selected particles
+            forward = moves == MOVE_FORWARD
+            up = moves == MOVE_UP
+            down = moves == MOVE_DOWN
+            current[t] += np.count_nonzero(forward)
+            YcurrentII_fast += np.bincount(selectedY[forward & fast], minlength=Ly)
+            YcurrentII_slow += np.bincount(selectedY[forward & slow], minlength=Ly)
+            YcurrentT_fast += np.bincount(selectedY[down & fast], minlength=Ly) - np.bincount(selectedY[up & fast], minlength=Ly)
+            YcurrentT_slow += np.bincount(selectedY[down & slow], minlength=Ly) - np.bincount(selectedY[up & slow], minlength=Ly)
+
+            # particles in their respective areas after each move
+            fast_sites[t] += right_fast.sum()
+            slow_sites[t] += right_slow.sum()
+
+            if recorder is not None:
+                recorder.record(lattice, t*Lx*Ly + min(block_start + K, Lx*Ly))
+
+    if recorder is not None:
+        recorder.close()
+
+    return current, empty_sites, fast_chosen, slow_chosen, fast_sites, slow_sites, YcurrentII_fast, YcurrentII_slow, YcurrentT_fast, YcurrentT_slow
+
 def plot_score(show_result=False):
     plt.figure(1)
     if show_result:
@@ -512,16 +983,26 @@ if __name__ == '__main__':
     log_post = False
     ############# Model parameters for Machine Learning #############
     num_episodes = 100       # number of training episodes
+    n_envs = 1               # independent lattices simulated in lockstep, one network call selects the actions of all of them
     BATCH_SIZE = 100        # the number of transitions sampled from the replay buffer
     GAMMA = 0.99            # the discounting factor
     EPS_START = 0.9         # EPS_START is the starting value of epsilon; determines how random our action choises are at the beginning
     EPS_END = 0.001         # EPS_END is the final value of epsilon
     EPS_DECAY = 200         # EPS_DECAY controls the rate of exponential decay of epsilon, higher means a slower decay
     TAU = 0.005             # TAU is the update rate of the target network
+    HARD_UPDATE = 0         # if > 0, the target network is instead copied from the policy network every HARD_UPDATE steps
+    ASYNC_LEARNER = False   # optimise in a background thread while the simulation continues
+    PUBLISH_EVERY = 1       # learning steps between copies of the policy network to the acting network (ASYNC_LEARNER only)
+    MAX_PENDING = 4         # learning steps the simulation can be ahead of the learner before waiting (ASYNC_LEARNER only)
     LR = 1e-3               # LR is the learning rate of the AdamW optimizer
+    seed = 0                # root seed of all the random streams (None for a different simulation every time)
     ############# Lattice simulation parameters #############
     L = 5                   # squared patches for the training
     density = 0.5           # work with half-density
+    # weights of the reward components of rewards.py (besides +1 for choosing a particle and -10 for an empty site)
+    reward_weights = {"forward_jump": 1, "neighbour_exclusion": 1, "lane_boundary": 1}
+    fast_fraction = 1.      # probability of a particle to be fast (speed 1) instead of slow (0.8)
+    init = "random"         # initial lattice: "random" (density) or "chess" (checkerboard, half-density)
     Lx = 10
     Ly = 10
     N = int(Lx*Ly*density)
@@ -530,15 +1011,26 @@ if __name__ == '__main__':
     n_observations = 2*L*L + 1 # three channels. Two of the patch size: fast and slow particles and one with the distance to the center
     n_actions = L*L            # patch size, in principle, the empty spots can also be selected
     hidden_size = 128          # hidden size of the network
+    policy = "mlp"             # "mlp": DQN on the L x L patches; "conv": ConvDQN that scores every site of the lattice in one pass
+    CONV_REFRESH = 1           # ConvDQN training: moves per forward pass, the moves of a block take the best distinct sites
+    if policy == "conv":
+        n_observations = 2*Lx*Ly + 1 # whole-lattice states, see whole_lattice_states
+        n_actions = Lx*Ly
+    compact_memory = False     # bit-packed replay memory (~30x smaller), decoded when sampling
+    store_moves = False        # replay memory keeps the moves instead of the next states, rebuilt when sampling
     PATH = f"./2d_TASEP_NN_params_{Lx}x{Ly}.txt"
+    # independent random streams for the network initialisation, the replay sampling, the training episodes and the post-training runs
+    net_seed, memory_seed, training_seed, post_seed = seed_sequence(seed).spawn(4)
 
     ############# Do the training if needed ##############
     if Jessie_we_need_to_train_NN:
-        policy_net = DQN(n_observations, hidden_size, n_actions).to(device)
-        target_net = DQN(n_observations, hidden_size, n_actions).to(device)
+        torch.manual_seed(int(net_seed.generate_state(1)[0]))
+        policy_net = make_net(policy, n_observations, hidden_size, n_actions, Lx, Ly, L).to(device)
+        target_net = make_net(policy, n_observations, hidden_size, n_actions, Lx, Ly, L).to(device)
         target_net.load_state_dict(policy_net.state_dict())
         optimizer = optim.AdamW(policy_net.parameters(), lr=LR, amsgrad=True)
-        memory = ReplayMemory(100*Nt) # the overall memory batch size 
+        acting_net = policy_net # network that chooses the actions; a published copy when ASYNC_LEARNER is on
+        memory = ReplayMemory(100*Nt, n_observations, compact_memory, store_moves, memory_seed) # the overall memory batch size 
         rewards = []
         current = []
         empty_sites = []
@@ -548,7 +1040,7 @@ if __name__ == '__main__':
         slow_sites = []
         steps_done = 0
 
-        do_training(num_episodes, L, density, Nt, Lx, Ly, boundary_lane, log) 
+        do_training(num_episodes, L, density, Nt, Lx, Ly, boundary_lane, log, training_seed) 
 
     ############# Post-training simulation ##############
     if Post_training:
@@ -556,9 +1048,28 @@ if __name__ == '__main__':
         Lx = 10
         Ly = 10
         Nt = 1000
-        trained_net = DQN(n_observations, hidden_size, n_actions).to(device)
+        trained_net = make_net(policy, n_observations, hidden_size, n_actions, Lx, Ly, L).to(device)
         trained_net.load_state_dict(torch.load(PATH))
+        sliding = False        # "mlp" policy: evaluate the trained DQN as convolutions over the whole lattice (mlp_to_conv), one pass per block of K moves
+        if sliding and policy == "mlp":
+            trained_net = mlp_to_conv(trained_net, L)
+        random_baseline = False # True to pick the sites at random instead of with the trained NN (Random2d_TASEP_current_* files)
+        kinetic = False        # with random_baseline: rejection-free continuous-time dynamics (KineticState) instead of move attempts
+        K = 1                  # staleness: move attempts drawn and evaluated per forward pass (1 = exact dynamics, Lx*Ly = one pass per sweep)
+        workers = 1            # processes for the runs (1 = serial); the results only depend on the seed
+        movie_file = None      # e.g. "./movie_frames.npy": frames of the last run for creating_movie.py (see MovieRecorder)
+        movie_stride = Lx*Ly   # move attempts between two frames (Lx*Ly = one frame per sweep)
+
+        seeds = post_seed.spawn(runs) # independent random stream of each run
+        movies = [None]*(runs - 1) + [movie_file] # only the last run is recorded
+        run_args = (trained_net, Lx, Ly, L, Nt, density, boundary_lane, K, random_baseline, init, fast_fraction, log, kinetic, movie_stride)
+        if workers > 1: # every run in a worker process with its own copy of the network
+            with ProcessPoolExecutor(max_workers=workers, initializer=torch.set_num_threads, initargs=(1,)) as executor:
+                results = list(tqdm(executor.map(post_training_run, seeds, *[repeat(arg) for arg in run_args], movies), total=runs))
+        else:
+            results = [post_training_run(run_seed, *run_args, run_movie) for run_seed, run_movie in tqdm(zip(seeds, movies), total=runs)]
 
+        # sum of the observables of all runs, always in run order so the serial and parallel results are identical
         current = np.zeros(Nt)
         empty_sites = np.zeros(Nt)
         fast_chosen = np.zeros(Nt)    
@@ -569,128 +1080,17 @@ if __name__ == '__main__':
         YcurrentII_slow = np.zeros(Ly) 
         YcurrentT_fast = np.zeros(Ly)  # perpendicular current for fast particles
         YcurrentT_slow = np.zeros(Ly)
-
-        for run in tqdm(range(runs)):
-            # start with random initial conditions
-            N = int(Lx*Ly*density) 
-            lattice = np.zeros(shape=(Lx,Ly))
-            n = 0
-            while n < N:
-                X = random.randint(0, Lx-1)
-                Y = random.randint(0, Ly-1)
-                if lattice[X][Y] == 0:
-                    lattice[X][Y] = Random.choice([0.8, 1], p =[0,1])
-                    n += 1
-
-            for t in tqdm(range(Nt)):
-                total_current = 0
-                selected_empty_site = 0
-                selected_fast = 0
-                selected_slow = 0                
-                right_fast = 0
-                right_slow = 0
-
-                for move_attempt in range(Lx*Ly):
-                    total_fast, fast_up  = 0, 0
-                    total_slow, slow_down = 0, 0
-
-                   # Random sampling of the new lattice to apply the training
-                    Xcenter = random.randint(0, Lx-1)
-                    Ycenter = random.randint(0, Ly-1)
-
-                    state = get_state_system(lattice, Lx, Ly, Xcenter, Ycenter, L)
-                    state = torch.tensor(state, dtype=torch.float32, device=device).unsqueeze(0)
-                    action = select_action_post_training(state)
-                    lattice_site = action.item() # a number, and we encode it as x*L + y
-                    patchX = int(lattice_site / L)
-                    patchY = int(lattice_site % L)
-                    selectedX, selectedY = get_coordinates_from_patch(patchX, patchY, Xcenter, Ycenter, L, Lx, Ly)
-
-                    # to check how does the simulation perform for the random "stupid" simulation, 
-                    # uncomment two lines below and comment the two lines above
-                    # selectedX = random.randint(0, Lx-1)
-                    # selectedY = random.randint(0, Ly-1)
-
-                    if lattice[selectedX][selectedY] != 0:
-                        newX = -1
-                        newY = -1
-                        nextX = selectedX + 1 if selectedX < Lx - 1 else 0
-                        nextY = selectedY + 1 if selectedY < Ly - 1 else 0
-                        prevY = selectedY - 1 if selectedY > 0 else Ly - 1
-                        # update position
-                        direction = random.randint(0,3)
-                        if direction == 0 or direction == 1: # jump to the right
-                            newX = nextX
-                            newY = selectedY
-                        elif direction == 2: # jump to the top
-                            newY = nextY
-                            newX = selectedX
-                        else: # jump to the bottom
-                            newY = prevY
-                            newX = selectedX
-
-                        jump_dice = random.random()
-                        speed = lattice[selectedX][selectedY]
-
-                        # counting of selected fast and slow particles
-                        if speed == 1:
-                            selected_fast += 1/(Lx*Ly*runs)
-                        else:
-                            selected_slow += 1/(Lx*Ly*runs)     
-
-                        if jump_dice <= speed:
-                            if lattice[newX][newY] == 0:
-                                lattice[selectedX][selectedY] = 0
-                                lattice[newX][newY] = speed
-                                if newX != selectedX: # we have jump forward
-                                    total_current += 1/(Lx*Ly*runs)
-                                    if speed == 1:
-                                        YcurrentII_fast[selectedY] += 1/(Lx*Ly*Nt*runs)
-                                    else:
-                                        YcurrentII_slow[selectedY] += 1/(Lx*Ly*Nt*runs)
-
-                                elif newY == nextY:
-                                    if log == True:
-                                        print("  moved up")
-                                    if speed == 1:
-                                        YcurrentT_fast[selectedY] += -1/(Lx*Ly*Nt*runs)
-                                    else:
-                                        YcurrentT_slow[selectedY] += -1/(Lx*Ly*Nt*runs)
-
-                                elif newY == prevY:
-                                    if log == True:
-                                        print("  moved down")
-                                    if speed == 1:
-                                        YcurrentT_fast[selectedY] += 1/(Lx*Ly*Nt*runs)
-                                    else:
-                                        YcurrentT_slow[selectedY] += 1/(Lx*Ly*Nt*runs)
-                                                                  
-                    else:
-                        if log == True:
-                            print("ALARM! ALARM!")                            
-                            print("empty site chosen")
-                        selected_empty_site += 1/(Lx*Ly*runs)
-
-                    # counting particles in their respective areas    
-                    for i in range(Lx):
-                        for j in range(Ly):
-                            if lattice[i][j] == 1:
-                                total_fast += 1
-                                if j < boundary_lane:
-                                    fast_up += 1
-                            elif lattice[i][j] != 0:
-                                total_slow += 1
-                                if j >= boundary_lane:
-                                    slow_down += 1
-                    right_fast += fast_up /(total_fast*Lx*Ly*runs) if total_fast != 0 else 0
-                    right_slow += slow_down / (total_slow*Lx*Ly*runs) if total_slow != 0 else 0                        
-
-                current[t] += total_current #sum of the currents of all runs
-                empty_sites[t] += selected_empty_site
-                fast_chosen[t] += selected_fast
-                slow_chosen[t] += selected_slow              
-                fast_sites[t] += right_fast
-                slow_sites[t] += right_slow
+        for result in results:
+            current += result[0]/(Lx*Ly*runs)
+            empty_sites += result[1]/(Lx*Ly*runs)
+            fast_chosen += result[2]/(Lx*Ly*runs)
+            slow_chosen += result[3]/(Lx*Ly*runs)
+            fast_sites += result[4]/(Lx*Ly*runs)
+            slow_sites += result[5]/(Lx*Ly*runs)
+            YcurrentII_fast += result[6]/(Lx*Ly*Nt*runs)
+            YcurrentII_slow += result[7]/(Lx*Ly*Nt*runs)
+            YcurrentT_fast += result[8]/(Lx*Ly*Nt*runs)
+            YcurrentT_slow += result[9]/(Lx*Ly*Nt*runs)
 
         plot_current(current, post = True)
         plt.savefig(f"./Post_Current_{runs}_{Lx}x{Ly}.png", format="png", dpi=600)
@@ -706,7 +1106,7 @@ if __name__ == '__main__':
         plt.savefig(f"./Post_Y_CurrentT_{runs}_{Lx}x{Ly}.png", format="png", dpi=600)  
 
 
-        filename = "2d_TASEP_current_" + str(Lx) + "x" + str(Ly) + "_runs" + str(runs) + ".txt"
+        filename = ("Random" if random_baseline else "") + "2d_TASEP_current_" + str(Lx) + "x" + str(Ly) + "_runs" + str(runs) + ".txt"
         with open(filename, 'w') as f:
             for t in range(Nt):
                 output_string = str(t) + "\t" + str(current[t]) + "\n"
@@ -1,7 +1,6 @@
 
 
 import numpy as np
-import pickle
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
 from mpl_toolkits.axes_grid1 import make_axes_locatable
@@ -18,7 +17,10 @@ def create_animation(Frames_movie):
     
     cv0 = Frames_movie[0]
     cmap=colors.ListedColormap(['black', 'purple', 'yellow'])
-    bounds = [0,0.25,0.85,1]
+    if Frames_movie.dtype == np.uint8: # species codes of MovieRecorder: 0 empty, 1 slow, 2 fast
+        bounds = [0,0.5,1.5,2.5]
+    else: # speeds (0, 0.8, 1) of the older movie_storage.pkl frames
+        bounds = [0,0.25,0.85,1]
     norm = colors.BoundaryNorm(bounds, cmap.N)
     im = ax.imshow(cv0, cmap=cmap, norm=norm)
 
@@ -30,11 +32,8 @@ def create_animation(Frames_movie):
     plt.close()  # To not have the plot of frame 0
 
     def animate(frame):
-        arr = Frames_movie[frame]
-        vmax = 1
-        vmin = np.min(arr)
+        arr = Frames_movie[frame] # read from disk only when drawn
         im.set_data(arr)
-        im.set_clim(vmin, vmax)
         # cb.ax.set_ylabel('Jumping Rate')
         tx.set_text('Frame {0}'.format(frame))
 
@@ -48,10 +47,9 @@ if __name__ == '__main__':
     newLy = 12
     Nt = 1000
 
-    with open(f"./movie_storage.pkl", 'rb') as file:
-        movie_storage = pickle.load(file)
+    movie_frames = np.load("./movie_frames.npy", mmap_mode='r') # written by the post-training of Lanes_code.py (movie_file)
     print('Action! (recording movie)')
-    ani = create_animation(movie_storage[:Nt]) #last run
+    ani = create_animation(movie_frames[:Nt]) #last run
     HTML(ani.to_jshtml()) # interactive python
     ani.save("./Movie"+".gif", fps = 8)
     print('Cut! (movie ready)')    
@@ -0,0 +1,278 @@
+import numpy as np
+from numba import njit
+from collections import namedtuple
+from tasep_kernels import MOVE_FORWARD, like_unlike
+
+# reward components of the smart TASEP, registered by name and composed with weights by Reward.
+# Every component works on a batch of K move attempts of selected particles on one lattice (Moves, arrays of length K) and returns
+# the K rewards, read from the lattice state after all the moves: exact per move for K = 1 (Reward.single), while for K > 1
+# the reward of a move also sees the later moves of the batch
+
+# speed of the selected particle, its site before (X, Y) and after (newX, newY) the move (the same site if it did not move),
+# kind of move (tasep_kernels.NO_MOVE, MOVE_FORWARD, ...) and center of the patch it was selected from
+Moves = namedtuple('Moves', ('speed', 'X', 'Y', 'newX', 'newY', 'move', 'Xcenter', 'Ycenter'))
+
+REWARDS = {} # name -> component class, built with (Lx, Ly, L, boundary_lane, slow_speed) and called with (lattice_state, moves)
+
+def register(name):
+    def decorator(component):
+        REWARDS[name] = component
+        return component
+    return decorator
+
+@njit(cache=True, nogil=True)
+def forward_jump_kernel(move):
+ # 1 for a jump along the driving direction
+    rewards = np.zeros(move.shape[0])
+    for k in range(move.shape[0]):
+        if move[k] == MOVE_FORWARD:
+            rewards[k] = 1
+    return rewards
+
+@njit(cache=True, nogil=True)
+def neighbour_exclusion_kernel(lattice, X, Y):
+ # +1 if the site in front of the selected site is empty, -1 if it is occupied
+    Lx = lattice.shape[0]
+    rewards = np.zeros(X.shape[0])
+    for k in range(X.shape[0]):
+        nextX = X[k] + 1 if X[k] < Lx - 1 else 0
+        rewards[k] = -1 if lattice[nextX, Y[k]] != 0 else 1
+    return rewards
+
+@njit(cache=True, nogil=True)
+def transverse_exclusion_kernel(lattice, X, Y):
+ # -1 for every occupied site above and below the selected site
+    Ly = lattice.shape[1]
+    rewards = np.zeros(X.shape[0])
+    for k in range(X.shape[0]):
+        nextY = Y[k] + 1 if Y[k] < Ly - 1 else 0
+        prevY = Y[k] - 1 if Y[k] > 0 else Ly - 1
+        rewards[k] = -1.*(lattice[X[k], nextY] != 0) - 1.*(lattice[X[k], prevY] != 0)
+    return rewards
+
+@njit(cache=True, nogil=True)
+def cluster_counting_kernel(lattice, neighbour_fast, neighbour_slow, newX, newY):
+ # like minus unlike particles among the 4 nearest neighbours of the particle after its move (O(1) lookups of the neighbour counts)
+    rewards = np.zeros(newX.shape[0])
+    for k in range(newX.shape[0]):
+        speed = lattice[newX[k], newY[k]]
+        if speed != 0:
+            like, unlike = like_unlike(neighbour_fast, neighbour_slow, speed, newX[k], newY[k])
+            rewards[k] = like - unlike
+    return rewards
+
+@njit(cache=True, nogil=True)
+def velocity_difference_kernel(lattice, neighbour_fast, neighbour_slow, newX, newY, speed_difference):
+ # minus the sum over the 4 nearest neighbours of the particle after its move of d = |v_neighbour - v|, with d = -1 for an empty neighbour:
+ # like neighbours give 0, unlike neighbours -speed_difference and empty sites +1
+    rewards = np.zeros(newX.shape[0])
+    for k in range(newX.shape[0]):
+        speed = lattice[newX[k], newY[k]]
+        if speed != 0:
+            like, unlike = like_unlike(neighbour_fast, neighbour_slow, speed, newX[k], newY[k])
+            rewards[k] = (4 - like - unlike) - speed_difference*unlike
+    return rewards
+
+@njit(cache=True, nogil=True)
+def occupied_neighbours_kernel(lattice, neighbour_fast, neighbour_slow, newX, newY):
+ # occupied nearest neighbours of the particle after its move
+    rewards = np.zeros(newX.shape[0])
+    for k in range(newX.shape[0]):
+        if lattice[newX[k], newY[k]] != 0:
+            rewards[k] = neighbour_fast[newX[k], newY[k]] + neighbour_slow[newX[k], newY[k]]
+    return rewards
+
+@njit(cache=True, nogil=True)
+def species_row_kernel(table, speed, Y):
+ # table[species, Y] lookup, species 0 for fast (speed 1) and 1 for slow particles
+    rewards = np.zeros(speed.shape[0])
+    for k in range(speed.shape[0]):
+        rewards[k] = table[0 if speed[k] == 1 else 1, Y[k]]
+    return rewards
+
+@njit(cache=True, nogil=True)
+def lane_boundary_kernel(window_fast, window_slow, boundaries, crosses, table, slow_speed, speed, Y, Xcenter, Ycenter):
+ # sum over the boundary rows crossed by the patch of table[species, k, Y, present], with present telling whether
+ # there are particles of the species in the boundary row of the patch columns (window counts of the lattice state)
+    rewards = np.zeros(speed.shape[0])
+    for k in range(speed.shape[0]):
+        if speed[k] == 1:
+            species, window = 0, window_fast
+        elif speed[k] == slow_speed:
+            species, window = 1, window_slow
+        else:
+            continue
+        for slot in range(boundaries.shape[0]):
+            if crosses[Ycenter[k], slot]:
+                present = 1 if window[Xcenter[k], boundaries[slot]] > 0 else 0
+                rewards[k] += table[species, slot, Y[k], present]
+    return rewards
+
+@register("forward_jump")
+class ForwardJump(object):
+ # rewards the current along the driving direction
+    def __init__(self, Lx, Ly, L, boundary_lane, slow_speed = 0.8):
+        pass
+
+    def __call__(self, lattice_state, moves):
+        return forward_jump_kernel(moves.move)
+
+@register("neighbour_exclusion")
+class NeighbourExclusion(object):
+ # rewards an empty site in front of the selected particle (read after the move)
+    def __init__(self, Lx, Ly, L, boundary_lane, slow_speed = 0.8):
+        pass
+
+    def __call__(self, lattice_state, moves):
+        return neighbour_exclusion_kernel(lattice_state.lattice, moves.X, moves.Y)
+
+@register("transverse_exclusion")
+class TransverseExclusion(object):
+ # penalises the particles above and below the selected site (read after the move), as in the cluster reward scripts
+    def __init__(self, Lx, Ly, L, boundary_lane, slow_speed = 0.8):
+        pass
+
+    def __call__(self, lattice_state, moves):
+        return transverse_exclusion_kernel(lattice_state.lattice, moves.X, moves.Y)
+
+@register("cluster_counting")
+class ClusterCounting(object):
+ # rewards a particle for having neighbours of its own species and penalises the other species
+    def __init__(self, Lx, Ly, L, boundary_lane, slow_speed = 0.8):
+        pass
+
+    def __call__(self, lattice_state, moves):
+        return cluster_counting_kernel(lattice_state.lattice, lattice_state.neighbour_fast, lattice_state.neighbour_slow, moves.newX, moves.newY)
+
+@register("velocity_difference")
+class VelocityDifference(object):
+ # penalises neighbours with a different speed (the diff_velocities term of the cluster reward scripts, without the int truncation)
+    def __init__(self, Lx, Ly, L, boundary_lane, slow_speed = 0.8, fast_speed = 1):
+        self.speed_difference = abs(fast_speed - slow_speed)
+
+    def __call__(self, lattice_state, moves):
+        return velocity_difference_kernel(lattice_state.lattice, lattice_state.neighbour_fast, lattice_state.neighbour_slow,
+                                          moves.newX, moves.newY, self.speed_difference)
+
+@register("lennard_jones")
+class LennardJones(object):
+ # Lennard-Jones-like term of the cluster reward scripts: -K*(1/r**2 - 1/r) per occupied nearest neighbour, at r = 1/d_c
+    def __init__(self, Lx, Ly, L, boundary_lane, slow_speed = 0.8, d_c = 1, K = 1):
+        r = 1/d_c
+        self.pair_energy = -K*(1/r**2 - 1/r)
+
+    def __call__(self, lattice_state, moves):
+        return self.pair_energy*occupied_neighbours_kernel(lattice_state.lattice, lattice_state.neighbour_fast, lattice_state.neighbour_slow,
+                                                           moves.newX, moves.newY)
+
+def wrong_side_value(speed, Y, boundary_lane, Ly):
+ # reward of a particle selected in row Y for the side of the system it is in: +5 on the rows next to the borders of its region,
+ # -1 inside the region of the other species for fast particles (and inside the fast region for slow ones), -5 otherwise
+    if speed == 1:
+        if Y == boundary_lane or Y == Ly-1:
+            return 5
+        elif Y > boundary_lane:
+            return -1
+        else:
+            return -5
+    else:
+        if Y == (boundary_lane-1) or Y == 0:
+            return 5
+        elif Y < boundary_lane:
+            return -1
+        else:
+            return -5
+
+@register("wrong_side")
+class WrongSide(object):
+ # row-dependent reward of the selected particle, tabulated per species and row, see wrong_side_value
+    def __init__(self, Lx, Ly, L, boundary_lane, slow_speed = 0.8):
+        self.table = np.array([[wrong_side_value(speed, Y, boundary_lane, Ly) for Y in range(Ly)] for speed in [1, slow_speed]], dtype=float)
+
+    def __call__(self, lattice_state, moves):
+        return species_row_kernel(self.table, moves.speed, moves.Y)
+
+def lane_ladder(speed, boundary, Y, present, boundary_lane, Ly, slow_speed = 0.8):
+ # lanes reward of a particle with the given speed, selected in row Y, for one boundary row crossed by the patch,
+ # with present telling whether there are particles of its species in the boundary row of the patch columns
+    reward = 0
+    if speed == 1:
+        if boundary == boundary_lane or boundary == (Ly-1):
+            if Y == boundary:
+                reward += 5
+            elif Y > boundary_lane and present: # slow region
+                reward += -1
+            elif Y < boundary_lane and present: # fast region
+                reward += -5
+
+        elif boundary == 0 or boundary == (boundary_lane-1):
+            if Y == boundary:
+                reward += 0
+            elif Y >= boundary_lane and present: # slow region
+                reward += -1
+            elif Y < boundary_lane and present: # fast region
+                reward += -5
+
+    elif speed == slow_speed:
+        if boundary == (boundary_lane-1) or boundary == 0:
+            if Y == boundary:
+                reward += 5
+            elif Y < boundary_lane and present: # fast region
+                reward += -1
+            elif Y >= boundary_lane and present: # slow region
+                reward += -5
+
+        elif boundary == boundary_lane or boundary == (Ly-1):
+            if Y == boundary:
+                reward += 0
+            elif Y > boundary_lane and present: # slow region
+                reward += -1
+            elif Y < boundary_lane and present: # fast region
+                reward += -5
+    return reward
+
+@register("lane_boundary")
+class LaneBoundary(object):
+ # lanes reward as table lookups: for the boundary rows [boundary_lane, boundary_lane-1, 0, Ly-1] it precomputes whether
+ # the patch centered at Ycenter crosses them, crosses[Ycenter, k], and the reward of lane_ladder for every species, boundary,
+ # selected row Y and presence of particles of the species in the boundary row, table[species, k, Y, present].
+ # The presence is read from the window counts of the LatticeState (built with the patch size L), so nothing is sliced or copied
+    def __init__(self, Lx, Ly, L, boundary_lane, slow_speed = 0.8):
+        self.boundaries = np.array([boundary_lane, (boundary_lane-1), 0, (Ly-1)])
+        distance = np.abs(self.boundaries[None, :] - np.arange(Ly)[:, None])
+        self.crosses = np.minimum(distance, Ly - distance) <= int(L/2)
+        self.table = np.zeros((2, len(self.boundaries), Ly, 2))
+        self.slow_speed = slow_speed
+        for species, speed in enumerate([1, slow_speed]):
+            for k, boundary in enumerate(self.boundaries):
+                for Y in range(Ly):
+                    for present in [0, 1]:
+                        self.table[species, k, Y, present] = lane_ladder(speed, boundary, Y, present, boundary_lane, Ly, slow_speed)
+
+    def __call__(self, lattice_state, moves):
+        if lattice_state.window_fast.shape[0] == 0:
+            raise ValueError("lane_boundary needs the window counts: build the LatticeState with the patch size L")
+        return lane_boundary_kernel(lattice_state.window_fast, lattice_state.window_slow, self.boundaries, self.crosses, self.table,
+                                    self.slow_speed, moves.speed, moves.Y, moves.Xcenter, moves.Ycenter)
+
+class Reward(object):
+ # weighted sum of registered components, e.g. Reward({"forward_jump": 1, "lane_boundary": 1}, Lx, Ly, L, boundary_lane),
+ # with slow_speed the speed of the slow particles (as in initial_lattice)
+    def __init__(self, weights, Lx, Ly, L, boundary_lane, slow_speed = 0.8):
+        unknown = [name for name in weights if name not in REWARDS]
+        if unknown:
+            raise ValueError(f"unknown reward components {unknown}, registered: {list(REWARDS)}")
+        self.weights = dict(weights)
+        self.components = {name: REWARDS[name](Lx, Ly, L, boundary_lane, slow_speed) for name in weights}
+
+    def __call__(self, lattice_state, moves):
+        rewards = np.zeros(len(moves.X))
+        for name, component in self.components.items():
+            rewards += self.weights[name] * component(lattice_state, moves)
+        return rewards
+
+    def single(self, lattice_state, speed, X, Y, newX, newY, move, Xcenter, Ycenter):
+     # reward of a single move attempt
+        moves = Moves(np.array([speed]), np.array([X]), np.array([Y]), np.array([newX]), np.array([newY]),
+                      np.array([move]), np.array([Xcenter]), np.array([Ycenter]))
+        return self(lattice_state, moves)[0]
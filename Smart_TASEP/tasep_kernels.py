@@ -0,0 +1,405 @@
+import numpy as np
+from numba import njit
+
+# compiled random-sequential-update kernels for the smart TASEP lattice (Lx x Ly), lattice[X][Y] = 0 (empty), 0.8 (slow) or 1 (fast).
+# The random numbers are drawn by the caller and passed in, so the kernels are deterministic for given inputs,
+# and they release the GIL (nogil), so they can run alongside the learner thread of Lanes_code
+
+# kind of move done by a particle
+NO_MOVE = 0
+MOVE_FORWARD = 1
+MOVE_UP = 2 # towards Y + 1
+MOVE_DOWN = 3 # towards Y - 1
+
+@njit(cache=True, nogil=True)
+def jump(lattice, X, Y, direction, jump_dice):
+ # tries to move the particle at (X, Y): direction 0 or 1 jumps right, 2 up and 3 down (periodic boundaries),
+ # and the jump is done if jump_dice <= speed and the target site is free (empty sites never move).
+ # Returns the target site and the kind of move that happened
+    Lx, Ly = lattice.shape
+    if direction == 0 or direction == 1: # jump right
+        newX = X + 1 if X < Lx - 1 else 0
+        newY = Y
+        move = MOVE_FORWARD
+    elif direction == 2: # jump up
+        newX = X
+        newY = Y + 1 if Y < Ly - 1 else 0
+        move = MOVE_UP
+    else: # jump down
+        newX = X
+        newY = Y - 1 if Y > 0 else Ly - 1
+        move = MOVE_DOWN
+
+    speed = lattice[X, Y]
+    if speed != 0 and jump_dice <= speed and lattice[newX, newY] == 0:
+        lattice[X, Y] = 0
+        lattice[newX, newY] = speed
+        return newX, newY, move
+
+    return newX, newY, NO_MOVE
+
+@njit(cache=True, nogil=True)
+def count_regions(lattice, boundary_lane, row_fast, row_slow, counts):
+ # full scan of the lattice that fills the per-row (Y) particle counts and counts = [total_fast, fast_up, total_slow, slow_down],
+ # with fast_up the fast particles in the fast region (Y < boundary_lane) and slow_down the slow particles in the slow region
+    Lx, Ly = lattice.shape
+    row_fast[:] = 0
+    row_slow[:] = 0
+    for i in range(Lx):
+        for j in range(Ly):
+            if lattice[i, j] == 1:
+                row_fast[j] += 1
+            elif lattice[i, j] != 0:
+                row_slow[j] += 1
+
+    counts[0] = row_fast.sum()
+    counts[1] = row_fast[:boundary_lane].sum()
+    counts[2] = row_slow.sum()
+    counts[3] = row_slow[boundary_lane:].sum()
+
+@njit(cache=True, nogil=True)
+def update_regions(row_fast, row_slow, counts, boundary_lane, speed, Y, newY):
+ # O(1) update of the counters of count_regions after a particle with the given speed jumped from row Y to row newY
+    if Y == newY:
+        return
+    if speed == 1:
+        row_fast[Y] -= 1
+        row_fast[newY] += 1
+        counts[1] += (newY < boundary_lane) - (Y < boundary_lane)
+    else:
+        row_slow[Y] -= 1
+        row_slow[newY] += 1
+        counts[3] += (newY >= boundary_lane) - (Y >= boundary_lane)
+
+@njit(cache=True, nogil=True)
+def count_neighbours(lattice, neighbour_fast, neighbour_slow):
+ # full scan that fills neighbour_fast/neighbour_slow[X, Y], the fast and slow particles among the 4 nearest neighbours
+ # of every site (X, Y) of the lattice, occupied or not
+    Lx, Ly = lattice.shape
+    neighbour_fast[:, :] = 0
+    neighbour_slow[:, :] = 0
+    for X in range(Lx):
+        for Y in range(Ly):
+            if lattice[X, Y] != 0:
+                add_neighbour(neighbour_fast, neighbour_slow, lattice[X, Y], X, Y, 1)
+
+@njit(cache=True, nogil=True)
+def add_neighbour(neighbour_fast, neighbour_slow, speed, X, Y, sign):
+ # 4-neighbour stencil: adds sign to the counts of the neighbours of (X, Y) for a particle with the given speed at (X, Y)
+    Lx, Ly = neighbour_fast.shape
+    counts = neighbour_fast if speed == 1 else neighbour_slow
+    counts[X + 1 if X < Lx - 1 else 0, Y] += sign
+    counts[X - 1 if X > 0 else Lx - 1, Y] += sign
+    counts[X, Y + 1 if Y < Ly - 1 else 0] += sign
+    counts[X, Y - 1 if Y > 0 else Ly - 1] += sign
+
+@njit(cache=True, nogil=True)
+def update_neighbours(neighbour_fast, neighbour_slow, speed, X, Y, newX, newY):
+ # O(1) update of the neighbour counts of count_neighbours after a particle with the given speed jumped from (X, Y) to (newX, newY)
+    add_neighbour(neighbour_fast, neighbour_slow, speed, X, Y, -1)
+    add_neighbour(neighbour_fast, neighbour_slow, speed, newX, newY, 1)
+
+@njit(cache=True, nogil=True)
+def like_unlike(neighbour_fast, neighbour_slow, speed, X, Y):
+ # O(1) lookup of the neighbours of (X, Y) of the same species as a particle with the given speed, and of the other species
+    if speed == 1:
+        return neighbour_fast[X, Y], neighbour_slow[X, Y]
+    return neighbour_slow[X, Y], neighbour_fast[X, Y]
+
+@njit(cache=True, nogil=True)
+def region_fractions(counts):
+ # fraction of fast particles in the fast region and of slow particles in the slow region
+    right_fast = counts[1] / counts[0] if counts[0] != 0 else 0.
+    right_slow = counts[3] / counts[2] if counts[2] != 0 else 0.
+    return right_fast, right_slow
+
+def patch_columns_mask(Lx, L):
+ # mask (Lx x Lx) of the columns X covered by the patch columns of center Xcenter, mask[Xcenter, X]: the 2*int(L/2)+1
+ # columns from Xcenter - int(L/2) to Xcenter + int(L/2), with periodic boundaries, as sliced by the lanes reward
+    half_patch = int(L/2)
+    mask = np.zeros((Lx, Lx), dtype=bool)
+    for Xcenter in range(Lx):
+        start_idx = (Xcenter - half_patch) % Lx
+        end_idx = (Xcenter + half_patch + 1) % Lx
+        if start_idx < end_idx:
+            mask[Xcenter, start_idx:end_idx] = True
+        else:
+            mask[Xcenter, start_idx:Lx] = True
+            mask[Xcenter, 0:end_idx] = True
+    return mask
+
+def column_centers_table(mask):
+ # for every column X, the centers whose patch columns contain X (rows padded with -1)
+    width = mask.sum(axis=0).max()
+    table = np.full((mask.shape[1], width), -1, dtype=np.int64)
+    for X in range(mask.shape[1]):
+        centers = np.flatnonzero(mask[:, X])
+        table[X, :len(centers)] = centers
+    return table
+
+@njit(cache=True, nogil=True)
+def update_windows(column_centers, window_fast, window_slow, speed, X, Y, newX, newY):
+ # O(L) update of the per-center row counts window_*[Xcenter, Y] (particles of each species in row Y of the patch columns
+ # of Xcenter) after a particle with the given speed jumped from (X, Y) to (newX, newY)
+    window = window_fast if speed == 1 else window_slow
+    for Xcenter in column_centers[X]:
+        if Xcenter < 0:
+            break
+        window[Xcenter, Y] -= 1
+    for Xcenter in column_centers[newX]:
+        if Xcenter < 0:
+            break
+        window[Xcenter, newY] += 1
+
+@njit(cache=True, nogil=True)
+def apply_moves(lattice, row_fast, row_slow, counts, neighbour_fast, neighbour_slow, column_centers, window_fast, window_slow,
+                selectedX, selectedY, directions, jump_dice, boundary_lane):
+ # applies in sequence the move attempts of the selected sites with the pre-drawn directions (0-3) and jump dice (uniform [0, 1)),
+ # keeping the counters of count_regions and count_neighbours (and the window counts, if column_centers is not empty) up to date.
+ # Returns, per move attempt, the speed of the selected site (0 if it was empty), the kind of move done,
+ # and the fraction of fast/slow particles in their regions after the move
+    n_moves = selectedX.shape[0]
+    speeds = np.zeros(n_moves)
+    moves = np.zeros(n_moves, dtype=np.int8)
+    right_fast = np.zeros(n_moves)
+    right_slow = np.zeros(n_moves)
+
+    for k in range(n_moves):
+        X, Y = selectedX[k], selectedY[k]
+        speeds[k] = lattice[X, Y]
+        if speeds[k] != 0:
+            newX, newY, move = jump(lattice, X, Y, directions[k], jump_dice[k])
+            moves[k] = move
+            if move != NO_MOVE:
+                update_regions(row_fast, row_slow, counts, boundary_lane, speeds[k], Y, newY)
+                update_neighbours(neighbour_fast, neighbour_slow, speeds[k], X, Y, newX, newY)
+                if column_centers.shape[0] > 0:
+                    update_windows(column_centers, window_fast, window_slow, speeds[k], X, Y, newX, newY)
+
+        fast_fraction, slow_fraction = region_fractions(counts)
+        right_fast[k] = fast_fraction
+        right_slow[k] = slow_fraction
+
+    return speeds, moves, right_fast, right_slow
+
+# Continuous-time (rejection-free) version of the random sequential update. In a sweep every particle is picked once on average
+# and tries a jump right with probability 1/2, up or down with 1/4, done with probability speed if the target is free: every
+# possible jump is then an event of rate speed*p(direction) per sweep. The possible jumps are kept in one set per class
+# c = 3*species + d (species 0 fast, 1 slow; d = 0 right, 1 up, 2 down), members[c, :sizes[c]] with positions[c, site] the index
+# of the site in the set (-1 if absent), so every event is a successful jump, drawn with probability rate/total_rate
+KMC_PROBABILITIES = np.array([0.5, 0.25, 0.25])
+
+@njit(cache=True, nogil=True)
+def kmc_target(Lx, Ly, X, Y, d):
+ # target site of the jump of class direction d from (X, Y), periodic boundaries
+    if d == 0:
+        return X + 1 if X < Lx - 1 else 0, Y
+    if d == 1:
+        return X, Y + 1 if Y < Ly - 1 else 0
+    return X, Y - 1 if Y > 0 else Ly - 1
+
+@njit(cache=True, nogil=True)
+def kmc_update_site(lattice, members, positions, sizes, site):
+ # O(1) update of the sets of possible jumps for the site X*Ly + Y: the particle on it is put in the classes of its species
+ # whose target is free and removed from all the other classes (all of them if the site is empty)
+    Lx, Ly = lattice.shape
+    X, Y = site // Ly, site % Ly
+    speed = lattice[X, Y]
+    for c in range(6):
+        newX, newY = kmc_target(Lx, Ly, X, Y, c % 3)
+        possible = speed != 0 and (c < 3) == (speed == 1) and lattice[newX, newY] == 0
+        k = positions[c, site]
+        if possible and k < 0:
+            members[c, sizes[c]] = site
+            positions[c, site] = sizes[c]
+            sizes[c] += 1
+        elif not possible and k >= 0: # the last member takes its place
+            last = members[c, sizes[c] - 1]
+            members[c, k] = last
+            positions[c, last] = k
+            positions[c, site] = -1
+            sizes[c] -= 1
+
+@njit(cache=True, nogil=True)
+def kmc_sets(lattice):
+ # full scan that builds the sets of possible jumps of every class
+    Lx, Ly = lattice.shape
+    members = np.zeros((6, Lx*Ly), dtype=np.int64)
+    positions = np.full((6, Lx*Ly), -1, dtype=np.int64)
+    sizes = np.zeros(6, dtype=np.int64)
+    for site in range(Lx*Ly):
+        kmc_update_site(lattice, members, positions, sizes, site)
+    return members, positions, sizes
+
+@njit(cache=True, nogil=True)
+def kmc_update_around(lattice, members, positions, sizes, X, Y):
+ # the site (X, Y) and the three sites that can jump into it (from the left, from below and from above)
+    Lx, Ly = lattice.shape
+    kmc_update_site(lattice, members, positions, sizes, X*Ly + Y)
+    kmc_update_site(lattice, members, positions, sizes, (X - 1 if X > 0 else Lx - 1)*Ly + Y)
+    kmc_update_site(lattice, members, positions, sizes, X*Ly + (Y - 1 if Y > 0 else Ly - 1))
+    kmc_update_site(lattice, members, positions, sizes, X*Ly + (Y + 1 if Y < Ly - 1 else 0))
+
+@njit(cache=True, nogil=True)
+def kmc_advance(lattice, members, positions, sizes, rates, row_fast, row_slow, counts, neighbour_fast, neighbour_slow,
+                column_centers, window_fast, window_slow, boundary_lane, duration, uniforms, forward, transverse, region_time):
+ # evolves the lattice for duration sweeps of continuous time, two pre-drawn uniforms per event (waiting time and event),
+ # keeping the counters of apply_moves up to date. Adds to forward[species, Y] the jumps right and to transverse[species, Y]
+ # the jumps down minus up, per row Y of departure, and to region_time the time integrals of the fractions of region_fractions.
+ # Returns the time still to be done when the uniforms ran out (0 otherwise) and the uniforms used. A waiting time that
+ # overshoots the end of the interval is dropped: the exponential times are memoryless, so the next call draws a fresh one.
+ # A waiting time is only drawn when the uniform of its event is available too, so no drawn wait is ever thrown away
+ # for lack of uniforms (that would reject the short waits and bias the time between events)
+    Lx, Ly = lattice.shape
+    used = 0
+    while used + 2 <= uniforms.shape[0]:
+        total_rate = 0.
+        for c in range(6):
+            total_rate += sizes[c]*rates[c]
+        fast_fraction, slow_fraction = region_fractions(counts)
+        wait = -np.log(1. - uniforms[used])/total_rate if total_rate > 0 else np.inf
+        used += 1
+        if wait >= duration: # no more events in the interval (or no possible jump at all)
+            region_time[0] += fast_fraction*duration
+            region_time[1] += slow_fraction*duration
+            return 0., used
+        region_time[0] += fast_fraction*wait
+        region_time[1] += slow_fraction*wait
+        duration -= wait
+
+        # class with probability sizes*rates/total_rate, then a member uniformly (from the remainder of the same uniform)
+        pick = uniforms[used]*total_rate
+        used += 1
+        chosen = -1
+        for c in range(6):
+            if sizes[c] == 0:
+                continue
+            chosen = c
+            if pick < sizes[c]*rates[c]:
+                break
+            pick -= sizes[c]*rates[c]
+        k = min(int(pick/rates[chosen]), sizes[chosen] - 1)
+        site = members[chosen, k]
+        X, Y = site // Ly, site % Ly
+        speed = lattice[X, Y]
+        d = chosen % 3
+        newX, newY = kmc_target(Lx, Ly, X, Y, d)
+        lattice[X, Y] = 0
+        lattice[newX, newY] = speed
+
+        update_regions(row_fast, row_slow, counts, boundary_lane, speed, Y, newY)
+        update_neighbours(neighbour_fast, neighbour_slow, speed, X, Y, newX, newY)
+        if column_centers.shape[0] > 0:
+            update_windows(column_centers, window_fast, window_slow, speed, X, Y, newX, newY)
+        kmc_update_around(lattice, members, positions, sizes, X, Y)
+        kmc_update_around(lattice, members, positions, sizes, newX, newY)
+
+        species = chosen // 3
+        if d == 0:
+            forward[species, Y] += 1
+        elif d == 1:
+            transverse[species, Y] -= 1
+        else:
+            transverse[species, Y] += 1
+
+    return duration, used
+
+def initial_lattice(rng, Lx, Ly, density, fast_fraction = 1., init = "random", slow_speed = 0.8):
+ # initial lattice (Lx x Ly) drawn with the numpy generator rng, without rejection loop:
+ # "random" puts int(Lx*Ly*density) particles on distinct sites chosen at once, "chess" fills the sites with X+Y even
+ # (density 1/2, as checkboard in ClassicTASEP). Every particle is fast (speed 1) with probability fast_fraction, slow otherwise
+    if init == "random":
+        if not 0 <= density <= 1:
+            raise ValueError("density must be in [0, 1]")
+        sites = rng.choice(Lx*Ly, int(Lx*Ly*density), replace=False)
+    elif init == "chess":
+        X, Y = np.divmod(np.arange(Lx*Ly), Ly)
+        sites = np.flatnonzero((X + Y) % 2 == 0)
+    else:
+        raise ValueError(f"unknown init {init}, expected random or chess")
+
+    lattice = np.zeros(Lx*Ly)
+    lattice[sites] = np.where(rng.random(len(sites)) < fast_fraction, 1, slow_speed)
+    return lattice.reshape(Lx, Ly)
+
+class LatticeState(object):
+ # lattice (Lx x Ly) together with its occupancy counters: particles per row for each species and
+ # counts = [total_fast, fast_up, total_slow, slow_down]. The counters are computed once and then
+ # updated in O(1) on every accepted jump, so the region statistics never need a rescan of the lattice.
+ # The same holds for neighbour_fast/neighbour_slow[X, Y], the fast and slow particles next to every site (see count_neighbours).
+ # With the patch size L it also keeps window_fast/window_slow[Xcenter, Y], the particles of each species in row Y
+ # of the patch columns of Xcenter (see patch_columns_mask), updated in O(L) on every accepted jump
+    def __init__(self, lattice, boundary_lane, L = None):
+        self.lattice = lattice
+        self.boundary_lane = boundary_lane
+        Lx, Ly = lattice.shape
+        self.row_fast = np.zeros(Ly, dtype=np.int64)
+        self.row_slow = np.zeros(Ly, dtype=np.int64)
+        self.counts = np.zeros(4, dtype=np.int64)
+        count_regions(lattice, boundary_lane, self.row_fast, self.row_slow, self.counts)
+        self.neighbour_fast = np.zeros((Lx, Ly), dtype=np.int64)
+        self.neighbour_slow = np.zeros((Lx, Ly), dtype=np.int64)
+        count_neighbours(lattice, self.neighbour_fast, self.neighbour_slow)
+
+        if L is None: # no window counts
+            self.column_centers = np.zeros((0, 0), dtype=np.int64)
+            self.window_fast = np.zeros((0, 0), dtype=np.int64)
+            self.window_slow = np.zeros((0, 0), dtype=np.int64)
+        else:
+            mask = patch_columns_mask(Lx, L).astype(np.int64)
+            self.column_centers = column_centers_table(mask)
+            self.window_fast = mask @ (lattice == 1)
+            self.window_slow = mask @ ((lattice != 0) & (lattice != 1))
+
+    def jump(self, X, Y, direction, jump_dice):
+     # compiled exclusion move of the particle at (X, Y), see jump
+        speed = self.lattice[X, Y]
+        newX, newY, move = jump(self.lattice, X, Y, direction, jump_dice)
+        if move != NO_MOVE:
+            update_regions(self.row_fast, self.row_slow, self.counts, self.boundary_lane, speed, Y, newY)
+            update_neighbours(self.neighbour_fast, self.neighbour_slow, speed, X, Y, newX, newY)
+            if self.column_centers.shape[0] > 0:
+                update_windows(self.column_centers, self.window_fast, self.window_slow, speed, X, Y, newX, newY)
+        return newX, newY, move
+
+    def apply_moves(self, selectedX, selectedY, directions, jump_dice):
+     # block of move attempts, see apply_moves
+        return apply_moves(self.lattice, self.row_fast, self.row_slow, self.counts, self.neighbour_fast, self.neighbour_slow,
+                           self.column_centers, self.window_fast, self.window_slow,
+                           selectedX, selectedY, directions, jump_dice, self.boundary_lane)
+
+    def like_unlike(self, X, Y):
+     # neighbours of the particle at (X, Y) of its own species and of the other species, see like_unlike
+        return like_unlike(self.neighbour_fast, self.neighbour_slow, self.lattice[X, Y], X, Y)
+
+    def right_fast(self):
+     # fraction of fast particles in the fast region (Y < boundary_lane)
+        return self.counts[1] / self.counts[0] if self.counts[0] != 0 else 0
+
+    def right_slow(self):
+     # fraction of slow particles in the slow region (Y >= boundary_lane)
+        return self.counts[3] / self.counts[2] if self.counts[2] != 0 else 0
+
+class KineticState(LatticeState):
+ # LatticeState evolved with the rejection-free continuous-time dynamics of kmc_advance instead of move attempts,
+ # with one sweep as unit of time. slow_speed is the speed of the slow particles (as in initial_lattice)
+    def __init__(self, lattice, boundary_lane, L = None, slow_speed = 0.8):
+        super().__init__(lattice, boundary_lane, L)
+        self.rates = np.concatenate((KMC_PROBABILITIES, slow_speed*KMC_PROBABILITIES))
+        self.members, self.positions, self.sizes = kmc_sets(lattice)
+
+    def advance(self, rng, duration):
+     # evolves the lattice for duration sweeps, with the uniforms drawn from the numpy generator rng in blocks sized on the
+     # expected number of events. Returns forward[species, Y], transverse[species, Y] and region_time of kmc_advance
+        Ly = self.lattice.shape[1]
+        forward = np.zeros((2, Ly), dtype=np.int64)
+        transverse = np.zeros((2, Ly), dtype=np.int64)
+        region_time = np.zeros(2)
+        while duration > 0:
+            expected_events = duration*(self.sizes @ self.rates)
+            uniforms = rng.random(2*int(1.1*expected_events) + 16)
+            duration, used = kmc_advance(self.lattice, self.members, self.positions, self.sizes, self.rates,
+                                         self.row_fast, self.row_slow, self.counts, self.neighbour_fast, self.neighbour_slow,
+                                         self.column_centers, self.window_fast, self.window_slow, self.boundary_lane,
+                                         duration, uniforms, forward, transverse, region_time)
+        return forward, transverse, region_time